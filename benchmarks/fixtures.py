@@ -0,0 +1,71 @@
+# coding: utf-8
+"""Synthetic Zabbix API responses and exporter config for benchmarks
+
+   python -m benchmarks.fixtures --items 100000 --rules 300 --output /tmp/zabbix-bench
+"""
+import json
+import os
+
+import click
+
+
+def generate(items=10000, rules=300, rejects=3, hosts=100):
+    """Returns (exporter config, host.get response, item.get response)
+
+       About 10% of items match no rule, every 10th matched item is rejected,
+       every 20th item is not numeric.
+    """
+    config = {
+        'explicit_metrics': False,
+        'metrics': [{
+            'key': 'bench.metric[svc%d,*,*]' % r,
+            'name': 'svc%d_$1' % r,
+            'help': 'Synthetic service %d' % r,
+            'type': 'gauge',
+            'labels': {'kind': '$2'},
+            'reject': ['reject%d' % j for j in range(rejects)],
+        } for r in range(rules)]
+    }
+    services = rules + max(rules // 10, 1)
+
+    host_rows = [{'hostid': str(h), 'name': 'host-%d.example.com' % h} for h in range(1, hosts + 1)]
+    item_rows = []
+    for i in range(items):
+        kind = 'reject%d' % (i % rejects) if rejects and i % 10 == 0 else 'kind%d' % (i % 7)
+        item_rows.append({
+            'itemid': str(i + 1),
+            'name': 'Synthetic item %d' % i,
+            'key_': 'bench.metric[svc%d,stat%d,%s]' % (i % services, i % 13, kind),
+            'hostid': str(i % hosts + 1),
+            'value_type': '4' if i % 20 == 0 else str(i % 2 * 3),
+            'lastclock': str(1460359130 + i % 60),
+            'lastvalue': '%d.%d' % (i, i % 10),
+        })
+    item_rows.sort(key=lambda item: item['key_'])
+
+    return (config,
+            {'jsonrpc': '2.0', 'result': host_rows, 'id': 1},
+            {'jsonrpc': '2.0', 'result': item_rows, 'id': 2})
+
+
+def write(directory, **options):
+    config, hosts, items = generate(**options)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for name, data in (('config.json', config), ('host.get.json', hosts), ('item.get.json', items)):
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(data, f)
+
+
+@click.command()
+@click.option('--items', default=10000, help='Number of items')
+@click.option('--rules', default=300, help='Number of metric rules in config')
+@click.option('--rejects', default=3, help='Number of rejects per rule')
+@click.option('--hosts', default=100, help='Number of hosts')
+@click.option('--output', required=True, type=click.Path(file_okay=False), help='Directory to write fixtures to')
+def cli(output, **options):
+    write(output, **options)
+
+
+if __name__ == '__main__':
+    cli()
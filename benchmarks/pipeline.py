@@ -0,0 +1,99 @@
+# coding: utf-8
+"""Times collect/render pipeline stages on synthetic Zabbix fixtures
+
+   Serves synthetic item.get through zabbix_fake_app from tests/conftest.py,
+   results are printed as JSON so they can be compared between runs.
+   Run from repository root:
+
+   python -m benchmarks.pipeline --items 100000 --rules 300 --output results.json
+"""
+from __future__ import print_function
+
+import json
+import os
+import platform
+import sys
+import threading
+import timeit
+
+import click
+import requests
+from prometheus_client import REGISTRY
+from pytest_localserver.http import WSGIServer
+
+import zabbix_exporter
+from zabbix_exporter.core import ExporterServer, MetricsHandler, ZabbixCollector
+from zabbix_exporter.prometheus import generate_latest
+
+from . import fixtures
+from .render_benchmark import StaticRegistry
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+from conftest import zabbix_fake_app  # noqa
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def run(items, rules, rejects, hosts, repeat=3):
+    config, host_response, item_response = fixtures.generate(items=items, rules=rules, rejects=rejects, hosts=hosts)
+    zabbix = WSGIServer(application=zabbix_fake_app)
+    zabbix.start()
+    try:
+        collector = ZabbixCollector(base_url=zabbix.url, login='demo', password='demo', **config)
+        collector.host_mapping.mapping = {row['hostid']: row['name'] for row in host_response['result']}
+        zabbix_fake_app.status = 200
+        zabbix_fake_app.content = json.dumps(item_response)
+        item_rows = item_response['result']
+
+        timings = {}
+        timings['process_metric'] = best_of(lambda: [collector.process_metric(item) for item in item_rows], repeat)
+        timings['collect'] = best_of(lambda: list(collector.collect()), repeat)
+        families = list(collector.collect())
+        timings['generate_latest'] = best_of(lambda: generate_latest(StaticRegistry(families)), repeat)
+        timings['scrape'] = time_scrape(collector, repeat)
+    finally:
+        del zabbix_fake_app.status
+        del zabbix_fake_app.content
+        zabbix.stop()
+
+    return {
+        'version': zabbix_exporter.__version__,
+        'python': platform.python_version(),
+        'params': {'items': items, 'rules': rules, 'rejects': rejects, 'hosts': hosts, 'repeat': repeat},
+        'series': sum(len(f.samples) for f in families),
+        'seconds': timings,
+    }
+
+
+def time_scrape(collector, repeat):
+    """End-to-end HTTP scrape of exporter serving collector"""
+    REGISTRY.register(collector)
+    httpd = ExporterServer(('127.0.0.1', 0), MetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    url = 'http://127.0.0.1:%d/metrics' % httpd.server_address[1]
+    try:
+        return best_of(lambda: requests.get(url, headers={'Accept-Encoding': 'identity'}).content, repeat)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+        REGISTRY.unregister(collector)
+
+
+@click.command()
+@click.option('--items', default=10000, help='Number of items')
+@click.option('--rules', default=300, help='Number of metric rules in config')
+@click.option('--rejects', default=3, help='Number of rejects per rule')
+@click.option('--hosts', default=100, help='Number of hosts')
+@click.option('--repeat', default=3, help='Take best of N runs for every stage')
+@click.option('--output', type=click.File('w'), default='-', help='File to write JSON results to [default: stdout]')
+def cli(output, **options):
+    json.dump(run(**options), output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,70 @@
+# coding: utf-8
+"""Compares exposition renderer with the one it replaced
+
+   python -m benchmarks.render_benchmark [samples]
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+
+from prometheus_client import core
+
+from zabbix_exporter.prometheus import MetricFamily, generate_latest
+
+
+def legacy_generate_latest(registry):
+    '''Renderer as it was before zabbix_exporter.prometheus.render_metric'''
+    output = []
+    for metric in registry.collect():
+        output.append('# HELP {0} {1}'.format(
+            metric.name, metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
+        output.append('\n# TYPE {0} {1}\n'.format(metric.name, metric.type))
+        for sample in metric.samples:
+            if len(sample) == 3:
+                name, labels, value = sample
+                timestamp = None
+            else:
+                name, labels, value, timestamp = sample
+            if labels:
+                labelstr = '{{{0}}}'.format(','.join(
+                    ['{0}="{1}"'.format(
+                     k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+                     for k, v in sorted(labels.items())]))
+            else:
+                labelstr = ''
+            output.append('{0}{1} {2}{3}\n'.format(name, labelstr, core._floatToGoString(value),
+                                                   ' %s' % timestamp if timestamp else ''))
+    return ''.join(output).encode('utf-8')
+
+
+class StaticRegistry(object):
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return iter(self.families)
+
+
+def build_registry(samples, series_per_family=1000):
+    families = []
+    for f in range(max(samples // series_per_family, 1)):
+        family = MetricFamily('gauge', 'zabbix_metric_%d' % f, 'Synthetic metric %d' % f,
+                              labels=['app', 'instance', 'status'])
+        for i in range(series_per_family):
+            family.add_metric(['app%d' % (i % 50), 'host-%d.example.com' % (i // 50), 'status%d' % i],
+                              float(i * 1.5), 1460359130 + i)
+        families.append(family)
+    return StaticRegistry(families)
+
+
+def main(samples=1000000):
+    registry = build_registry(samples)
+    assert generate_latest(registry) == legacy_generate_latest(registry)
+    for func in (legacy_generate_latest, generate_latest):
+        seconds = min(timeit.repeat(lambda: func(registry), number=1, repeat=3))
+        print('{:25}{:>10} samples {:8.3f}s'.format(func.__name__, samples, seconds))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,79 @@
+# coding: utf-8
+"""Measures how rule processing scales with item count and number of rule processes
+
+   Times ZabbixCollector.process_items on synthetic items (see fixtures.py),
+   in exporter process and with `rule_processes` worker pools. Run from repository root:
+
+   python -m benchmarks.rule_scaling --items 20000 --items 100000 --processes 1 --processes 4
+"""
+from __future__ import print_function
+
+import json
+import multiprocessing
+import platform
+import timeit
+
+import click
+
+import zabbix_exporter
+from zabbix_exporter.core import HostCache, ZabbixCollector
+
+from . import fixtures
+
+
+def make_collector(config, host_rows, **options):
+    """Collector with rules and hosts, not connected to Zabbix API"""
+    collector = ZabbixCollector.__new__(ZabbixCollector)
+    collector.configure(dict(config, **options))
+    collector.host_mapping = HostCache(None)
+    collector.host_mapping.load(host_rows)
+    return collector
+
+
+def time_processing(collector, item_rows, repeat):
+    timings = timeit.repeat(lambda: collector.process_items(item_rows, {}), number=1, repeat=repeat)
+    return min(timings)
+
+
+def run(items, processes, rules, hosts, chunk_size, repeat=3):
+    results = []
+    for item_count in items:
+        config, host_response, item_response = fixtures.generate(items=item_count, rules=rules, hosts=hosts)
+        item_rows = item_response['result']
+        for process_count in processes:
+            collector = make_collector(config, host_response['result'],
+                                       rule_processes=process_count, rule_chunk_size=chunk_size)
+            collector.start_rule_pool()
+            try:
+                collector.process_items(item_rows[:chunk_size + 1], {})  # warm up worker processes
+                seconds = time_processing(collector, item_rows, repeat)
+            finally:
+                collector.close()
+            results.append({'items': item_count, 'processes': process_count, 'seconds': seconds,
+                            'items_per_second': item_count / seconds})
+    return {
+        'version': zabbix_exporter.__version__,
+        'python': platform.python_version(),
+        'cpus': multiprocessing.cpu_count(),
+        'params': {'rules': rules, 'hosts': hosts, 'chunk_size': chunk_size, 'repeat': repeat},
+        'results': results,
+    }
+
+
+@click.command()
+@click.option('--items', multiple=True, type=int, default=[10000, 50000, 100000],
+              help='Number of items, may be given several times')
+@click.option('--processes', multiple=True, type=int, default=[1, 2, 4],
+              help='Number of rule processes (1 - in exporter process), may be given several times')
+@click.option('--rules', default=300, help='Number of metric rules in config')
+@click.option('--hosts', default=100, help='Number of hosts')
+@click.option('--chunk-size', default=5000, help='Items per chunk sent to worker process')
+@click.option('--repeat', default=3, help='Take best of N runs')
+@click.option('--output', type=click.File('w'), default='-', help='File to write JSON results to [default: stdout]')
+def cli(output, **options):
+    json.dump(run(**options), output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    cli()
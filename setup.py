@@ -20,6 +20,12 @@ requirements = [
     'click>=6.4',
 ]
 
+extra_requirements = {
+    'zstd': ['zstandard'],
+    'orjson': ['orjson'],
+    'aiohttp': ['aiohttp>=3.3'],  # ClientTimeout
+}
+
 test_requirements = [
     'pytest>=3.0.0',
     'pytest-localserver>=0.3.5',
@@ -65,6 +71,7 @@ setup(
     package_dir={'zabbix_exporter': 'zabbix_exporter'},
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="BSD",
     zip_safe=False,
     keywords='zabbix_exporter',
@@ -23,6 +23,8 @@ def zabbix_fake_app(environ, start_response):
     response = Response(status=200, headers=[('Content-type', 'application/json')])
     if '"method": "user.login"' in request_body:
         json_string = '{"jsonrpc":"2.0","result":"9287f336ffb611e586aa5e5517507c66","id":0}'
+    elif '"method": "hostgroup.get"' in request_body:
+        json_string = open('tests/fixtures/hostgroup.get_success.json').read()
     elif '"method": "host.get"' in request_body:
         json_string = open('tests/fixtures/host.get_success.json').read()
     elif '"method": "item.get"' in request_body:
@@ -42,7 +44,7 @@ def zabbixserver(request):
     server = WSGIServer(application=zabbix_fake_app)
     server.start()
     request.addfinalizer(server.stop)
-    request._addfinalizer(func, scope='function')
+    request.addfinalizer(func)
     def serve_content(self, content, status=200):  # noqa
         self.app.content = content
         self.app.status = status
@@ -50,6 +52,21 @@ def zabbixserver(request):
     return server
 
 
+@pytest.fixture
+def record_requests(monkeypatch):
+    """Returns function starting to record (method, params) of API requests sent by collector"""
+    def record(collector):
+        requests = []
+        do_request = collector.zapi.do_request
+
+        def recording_request(method, params=None):
+            requests.append((method, params))
+            return do_request(method, params)
+        monkeypatch.setattr(collector.zapi, 'do_request', recording_request)
+        return requests
+    return record
+
+
 @pytest.fixture
 def zabbix_exporter_cli(request):
     def cli_launcher(args):
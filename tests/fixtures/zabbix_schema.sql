@@ -0,0 +1,47 @@
+-- Subset of Zabbix database schema read by DatabaseCollector
+CREATE TABLE hstgrp (
+    groupid INTEGER PRIMARY KEY,
+    name VARCHAR(255) NOT NULL
+);
+CREATE TABLE hosts (
+    hostid INTEGER PRIMARY KEY,
+    host VARCHAR(128) NOT NULL,
+    name VARCHAR(128) NOT NULL,
+    status INTEGER NOT NULL DEFAULT 0,
+    flags INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE hosts_groups (
+    hostgroupid INTEGER PRIMARY KEY,
+    hostid INTEGER NOT NULL,
+    groupid INTEGER NOT NULL
+);
+CREATE TABLE items (
+    itemid INTEGER PRIMARY KEY,
+    hostid INTEGER NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    key_ VARCHAR(255) NOT NULL,
+    value_type INTEGER NOT NULL,
+    status INTEGER NOT NULL DEFAULT 0,
+    flags INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE history (
+    itemid INTEGER NOT NULL,
+    clock INTEGER NOT NULL,
+    value DOUBLE PRECISION NOT NULL,
+    ns INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX history_1 ON history (itemid, clock);
+CREATE TABLE history_uint (
+    itemid INTEGER NOT NULL,
+    clock INTEGER NOT NULL,
+    value NUMERIC(20) NOT NULL,
+    ns INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX history_uint_1 ON history_uint (itemid, clock);
+CREATE TABLE history_str (
+    itemid INTEGER NOT NULL,
+    clock INTEGER NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    ns INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX history_str_1 ON history_str (itemid, clock);
@@ -1,7 +1,10 @@
 # coding: utf-8
+import gzip
+import time
 
 import pytest
 import requests
+import yaml
 
 from zabbix_exporter.prometheus import text_string_to_metric_families
 
@@ -88,3 +91,276 @@ def test_exporter_returns_500_on_scrape_errors(zabbixserver, zabbix_exporter_cli
     zabbixserver.serve_content('', 500)
     response = requests.get('http://localhost:9224/metrics/')
     assert response.status_code == 500
+
+
+def test_background_polling_serves_cached_payload(zabbixserver, zabbix_exporter_cli):
+    args = ['--url', zabbixserver.url,
+            '--no-verify', '--config', 'tests/configs/explicit_config.yaml',
+            '--login', 'demo', '--password', 'demo', '--port', '9224', '--poll-interval', '60']
+    zabbix_exporter_cli(args)
+    # zabbix is down, but cached payload is still served
+    zabbixserver.serve_content('', 500)
+    response = requests.get('http://localhost:9224/metrics/')
+    assert response.status_code == 200
+
+    metrics = {m.name: m for m in text_string_to_metric_families(response.text)}
+    assert 'uwsgi_workers' in metrics
+    assert metrics['zabbix_exporter_refresh_duration_seconds'].samples[0][2] > 0
+    assert metrics['zabbix_exporter_snapshot_age_seconds'].samples[0][2] < 60
+
+
+def test_streaming_response(zabbixserver, zabbix_exporter_cli):
+    args = ['--url', zabbixserver.url,
+            '--no-verify', '--config', 'tests/configs/explicit_config.yaml',
+            '--login', 'demo', '--password', 'demo', '--port', '9224', '--stream']
+    zabbix_exporter_cli(args)
+
+    response = requests.get('http://localhost:9224/metrics/')
+    assert response.headers['Transfer-Encoding'] == 'chunked'
+    metrics = [m.name for m in text_string_to_metric_families(response.text)
+               if not m.name.startswith('zabbix_exporter_') and not m.name.startswith('process_')]
+    assert metrics == ['redis_connected_clients', 'uwsgi_rss', 'uwsgi_workers', 'zfs_total_bytes']
+
+    zabbixserver.serve_content('', 500)
+    response = requests.get('http://localhost:9224/metrics/')
+    assert response.status_code == 500
+
+
+def test_concurrent_streamed_scrapes_share_collection():
+    import threading
+    from prometheus_client import REGISTRY
+    from prometheus_client.core import GaugeMetricFamily
+    from zabbix_exporter.core import ExporterServer, MetricsHandler
+
+    collections = []
+
+    class SlowCollector(object):
+        def describe(self):
+            return [GaugeMetricFamily('slow_metric', 'Slow metric')]
+
+        def collect(self):
+            collections.append(time.time())
+            time.sleep(0.5)
+            yield GaugeMetricFamily('slow_metric', 'Slow metric', value=1)
+    REGISTRY.register(SlowCollector())
+    httpd = ExporterServer(('', 9224), MetricsHandler)
+    httpd.stream = True
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    responses = []
+    scrapes = [threading.Thread(target=lambda: responses.append(requests.get('http://localhost:9224/metrics')))
+               for _ in range(3)]
+    try:
+        for scrape in scrapes:
+            scrape.start()
+        for scrape in scrapes:
+            scrape.join()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+    assert len(collections) == 1
+    assert [response.headers['Transfer-Encoding'] for response in responses] == ['chunked'] * 3
+    assert all('slow_metric 1.0' in response.text for response in responses)
+
+
+@pytest.mark.parametrize("extra_args", [[], ['--poll-interval', '60'], ['--stream']])
+def test_gzip_response(zabbixserver, zabbix_exporter_cli, extra_args):
+    args = ['--url', zabbixserver.url,
+            '--no-verify', '--config', 'tests/configs/explicit_config.yaml',
+            '--login', 'demo', '--password', 'demo', '--port', '9224'] + extra_args
+    zabbix_exporter_cli(args)
+
+    response = requests.get('http://localhost:9224/metrics/', headers={'Accept-Encoding': 'gzip'}, stream=True)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    text = gzip.GzipFile(fileobj=response.raw).read().decode('utf-8')
+    metrics = [m.name for m in text_string_to_metric_families(text)]
+    assert 'uwsgi_workers' in metrics
+    assert 'zabbix_exporter_scrapes_total' in metrics
+
+
+def test_stage_timings_and_rule_counters(zabbixserver, zabbix_exporter_cli):
+    args = ['--url', zabbixserver.url,
+            '--no-verify', '--config', 'tests/configs/explicit_config.yaml',
+            '--login', 'demo', '--password', 'demo', '--port', '9224']
+    zabbix_exporter_cli(args)
+
+    def scrape():
+        response = requests.get('http://localhost:9224/metrics/')
+        return {m.name: m for m in text_string_to_metric_families(response.text)}
+
+    def rule_counter(metrics, name):
+        return {s[1]['rule']: s[2] for s in metrics[name].samples}['local.metric[uwsgi,workers,*,*]']
+
+    first, second = scrape(), scrape()
+    stages = {s[1]['stage'] for s in second['zabbix_exporter_stage_seconds'].samples}
+    assert stages == {'api', 'decode', 'hosts', 'rules', 'collect', 'render', 'write'}
+    assert (rule_counter(second, 'zabbix_exporter_rule_matches_total') -
+            rule_counter(first, 'zabbix_exporter_rule_matches_total')) == 2
+    assert (rule_counter(second, 'zabbix_exporter_rule_rejects_total') -
+            rule_counter(first, 'zabbix_exporter_rule_rejects_total')) == 1
+
+
+def test_profile_endpoint(zabbixserver, zabbix_exporter_cli):
+    args = ['--url', zabbixserver.url,
+            '--no-verify', '--config', 'tests/configs/explicit_config.yaml',
+            '--login', 'demo', '--password', 'demo', '--port', '9224', '--enable-profiling']
+    zabbix_exporter_cli(args)
+    response = requests.get('http://localhost:9224/debug/profile?scrapes=2&filter=process_metric&limit=5')
+    assert response.status_code == 200
+    assert 'process_metric' in response.text
+
+
+def test_async_exporter(zabbixserver):
+    aiohttp = pytest.importorskip('aiohttp')
+    import asyncio
+    import threading
+    from zabbix_exporter.commands import cli
+
+    app = cli(prog_name='zabbix_exporter', standalone_mode=False, args=[
+        '--url', zabbixserver.url, '--config', 'tests/configs/explicit_config.yaml',
+        '--login', 'demo', '--password', 'demo', '--async', '--return-server'])
+    loop = asyncio.new_event_loop()
+    runner = aiohttp.web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(aiohttp.web.TCPSite(runner, 'localhost', 9224).start())
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        for _ in range(50):
+            if requests.get('http://localhost:9224/ready').status_code == 200:
+                break
+            time.sleep(0.1)
+        response = requests.get('http://localhost:9224/metrics')
+        target_response = requests.get('http://localhost:9224/metrics/' + zabbixserver.url.split('://')[1])
+        missing_response = requests.get('http://localhost:9224/metrics/unknown')
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+    metrics = {m.name: m for m in text_string_to_metric_families(response.text)}
+    assert [s[2] for s in metrics['uwsgi_workers'].samples] == [6.0, 10.0]
+    assert 'zabbix_exporter_scrapes_total' in metrics
+    assert 'uwsgi_workers' in target_response.text
+    assert missing_response.status_code == 404
+
+
+def test_multiple_targets(zabbixserver, zabbix_exporter_cli, tmpdir):
+    config = tmpdir.join('targets.yaml')
+    config.write(yaml.safe_dump({
+        'explicit_metrics': True,
+        'metrics': [{'key': 'local.metric[uwsgi,workers,*,*]', 'name': 'uwsgi_workers'}],
+        'targets': [
+            {'name': 'main', 'url': zabbixserver.url, 'login': 'demo', 'password': 'demo', 'poll_interval': 60},
+            {'name': 'implicit', 'url': zabbixserver.url, 'login': 'demo', 'password': 'demo',
+             'explicit_metrics': False},
+            {'name': 'down', 'url': 'http://localhost:1', 'login': 'demo', 'password': 'demo'},
+        ],
+    }))
+    zabbix_exporter_cli(['--config', str(config), '--port', '9224'])
+
+    main = requests.get('http://localhost:9224/probe?target=main')
+    implicit = requests.get('http://localhost:9224/metrics/implicit')
+    assert main.status_code == implicit.status_code == 200
+    assert 'uwsgi_workers' in main.text and 'zfs_total_bytes' not in main.text
+    assert 'zfs_total_bytes' in implicit.text
+
+    def dropped(response):  # rule counters are exported per target
+        families = {m.name: m for m in text_string_to_metric_families(response.text)}
+        return {s[1]['reason']: s[2] for s in families['zabbix_exporter_items_dropped_total'].samples}
+    assert dropped(main)['implicit'] > 0
+    assert dropped(implicit)['implicit'] == 0
+    assert requests.get('http://localhost:9224/probe?target=down').status_code == 500
+    assert requests.get('http://localhost:9224/probe?target=unknown').status_code == 404
+
+    metrics = {m.name: m for m in text_string_to_metric_families(requests.get('http://localhost:9224/metrics').text)}
+    assert 'uwsgi_workers' not in metrics
+    up = {s[1]['target']: s[2] for s in metrics['zabbix_exporter_target_up'].samples}
+    assert (up['main'], up['implicit'], up['down']) == (1.0, 1.0, 0.0)
+    ages = {s[1]['target'] for s in metrics['zabbix_exporter_snapshot_age_seconds'].samples}
+    assert 'main' in ages and 'implicit' not in ages
+    stages = {(s[1]['target'], s[1]['stage']) for s in metrics['zabbix_exporter_stage_seconds'].samples}
+    assert {('main', 'collect'), ('implicit', 'collect'), ('implicit', 'render')} <= stages
+    series = {s[1]['target']: s[2] for s in metrics['zabbix_exporter_series_total'].samples}
+    assert series['implicit'] > series['main'] > 0
+
+    compressed = requests.get('http://localhost:9224/probe?target=main', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.text == main.text
+
+
+def test_snapshot_is_saved_after_refresh(zabbixserver, zabbix_exporter_cli, tmpdir):
+    from zabbix_exporter.snapshot import Snapshot
+
+    path = str(tmpdir.join('snapshot'))
+    zabbix_exporter_cli(['--url', zabbixserver.url, '--config', 'tests/configs/explicit_config.yaml',
+                         '--login', 'demo', '--password', 'demo', '--port', '9224',
+                         '--poll-interval', '60', '--snapshot', path])
+    response = requests.get('http://localhost:9224/metrics')
+    snapshot = Snapshot.load(path)
+    assert snapshot.hosts == {'3': 'rough-snowflake-db', '4': 'rough-snowflake-web'}
+    assert snapshot.payload and response.content.startswith(snapshot.payload)
+
+
+def test_snapshot_is_served_before_zabbix_is_available(zabbixserver, zabbix_exporter_cli, tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    args = ['--url', zabbixserver.url, '--config', 'tests/configs/explicit_config.yaml',
+            '--login', 'demo', '--password', 'demo', '--poll-interval', '60', '--snapshot', path]
+    zabbix_exporter_cli(args + ['--port', '9224'])
+    assert 'uwsgi_workers' in requests.get('http://localhost:9224/metrics').text
+
+    zabbixserver.serve_content('Zabbix is down', 503)
+    zabbix_exporter_cli(args + ['--port', '9225'])
+    assert requests.get('http://localhost:9225/ready').status_code == 200
+    response = requests.get('http://localhost:9225/metrics')
+    assert response.status_code == 200
+    assert 'uwsgi_workers' in response.text
+
+
+def test_listener_is_ready_before_zabbix_is_available(zabbix_exporter_cli):
+    zabbix_exporter_cli(['--url', 'http://localhost:1', '--login', 'demo', '--password', 'demo', '--port', '9224'])
+
+    assert requests.get('http://localhost:9224/healthz').status_code == 200
+    assert requests.get('http://localhost:9224/ready').status_code == 503
+    assert requests.get('http://localhost:9224/metrics').status_code == 503
+
+
+def test_startup_duration_is_exported(zabbixserver, zabbix_exporter_cli):
+    zabbix_exporter_cli(['--url', zabbixserver.url, '--login', 'demo', '--password', 'demo', '--port', '9224'])
+
+    assert requests.get('http://localhost:9224/ready').status_code == 200
+    metrics = {m.name: m for m in text_string_to_metric_families(requests.get('http://localhost:9224/metrics').text)}
+    assert metrics['zabbix_exporter_startup_duration_seconds'].samples[0][2] > 0
+
+
+def test_idle_keepalive_connections_do_not_hold_workers(zabbixserver, zabbix_exporter_cli):
+    import socket
+    zabbix_exporter_cli(['--url', zabbixserver.url, '--login', 'demo', '--password', 'demo', '--port', '9224',
+                         '--workers', '2'])
+
+    sessions = [requests.Session() for _ in range(3)]
+    for session in sessions:  # connections stay open after response
+        assert session.get('http://localhost:9224/metrics').status_code == 200
+    idle = [socket.create_connection(('localhost', 9224)) for _ in range(2)]
+    try:
+        started = time.time()
+        assert requests.get('http://localhost:9224/healthz', timeout=3).status_code == 200
+        assert requests.get('http://localhost:9224/metrics', timeout=3).status_code == 200
+        assert time.time() - started < 1
+    finally:
+        for connection in idle:
+            connection.close()
+        for session in sessions:
+            session.close()
+
+    many = [socket.create_connection(('localhost', 9224)) for _ in range(8)]  # 4 connections per worker
+    try:
+        rejected = socket.create_connection(('localhost', 9224))
+        assert rejected.recv(1024).startswith(b'HTTP/1.1 503')
+        rejected.close()
+    finally:
+        for connection in many:
+            connection.close()
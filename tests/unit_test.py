@@ -1,7 +1,16 @@
 # coding: utf-8
+import json
+import threading
+import time
+
+import pytest
 import yaml
 
+from zabbix_exporter.api import get_decoder
 from zabbix_exporter.core import SortedDict, ZabbixCollector
+from zabbix_exporter.prometheus import MetricFamily, render_metric
+from zabbix_exporter.rules import RuleSet
+from zabbix_exporter.utils import SingleFlight, negotiate_encoding
 
 
 def test_sorted_keys_dict():
@@ -12,6 +21,28 @@ def test_sorted_keys_dict():
     assert '-'.join(map(str, d.values())) == '13-12-0-9-3-4-5-7-8-10-2-1-11-6-14-15'
 
 
+def test_single_flight_shares_result_between_concurrent_calls():
+    calls = []
+
+    def slow_collect():
+        calls.append(1)
+        time.sleep(0.2)
+        return b'payload'
+
+    flight = SingleFlight()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do(slow_collect))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [b'payload'] * 5
+    assert flight.do(slow_collect) == b'payload'
+    assert len(calls) == 2
+
+
 def test_metric_families_dont_override_each_other(zabbixserver):
     config = yaml.safe_load(open('tests/configs/asterisk.conf.yml'))
     collector = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', **config)
@@ -57,3 +88,533 @@ def test_reject_labels(zabbixserver):
           None)
          ],
     ]
+
+
+def test_rules_dispatch_by_key_prefix():
+    rules = RuleSet([
+        {'key': 'local.metric[uwsgi,workers,*,*]', 'name': 'uwsgi_workers', 'reject': ['total']},
+        {'key': 'local.metric[uwsgi,*,*,*]', 'name': 'uwsgi_$2'},
+        {'key': 'local.metric[redis,*,*]', 'name': 'redis_$1'},
+        {'key': 'system.metric'},
+    ])
+
+    assert [r.key for r in rules.candidates('local.metric[uwsgi,workers,app,busy]')] == [
+        'local.metric[uwsgi,workers,*,*]', 'local.metric[uwsgi,*,*,*]']
+    assert rules.candidates('zfs.total_bytes') == []
+
+    rule, match = rules.match('local.metric[uwsgi,workers,app,busy]')
+    assert rule.render_name(match) == 'uwsgi_workers'
+
+    # rejected by first rule, picked up by the next one
+    rule, match = rules.match('local.metric[uwsgi,workers,app,total]')
+    assert rule.render_name(match) == 'uwsgi_app'
+
+    rule, match = rules.match('system.metric[uname]')
+    assert rule.render_name(match) == 'system.metric[uname]'
+
+
+def test_rule_labels_are_rendered_in_schema_order():
+    rules = RuleSet([
+        {'key': 'local.metric[uwsgi,workers,*,*]', 'labels': {'status': '$2', 'app': '$1', 'kind': 'worker'}},
+    ])
+    rule, match = rules.match('local.metric[uwsgi,workers,myapp,busy]')
+
+    assert rule.labelnames == ('app', 'instance', 'kind', 'status')
+    assert rule.render_labels(match, 'host1') == ('myapp', 'host1', 'worker', 'busy')
+
+
+def test_items_are_fetched_in_host_batches(zabbixserver, record_requests):
+    collector = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', host_batch_size=1)
+    requests = record_requests(collector)
+
+    pages = list(collector.iter_item_pages())
+
+    assert len(pages) == 2
+    assert [params['hostids'] for method, params in requests] == [['3'], ['4']]
+
+
+def test_items_are_fetched_by_parallel_shards(zabbixserver):
+    collector = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', api_workers=2)
+
+    assert collector.host_batches() == [['3'], ['4']]
+    pages = list(collector.iter_item_pages())
+    assert len(pages) == 2
+    assert pages[0] == pages[1]  # fake server ignores hostids
+
+    fetched = []
+    collector.host_batches = lambda: [['3'], ['4']] * 3
+    collector.fetch_items = lambda hostids, output, filtered: fetched.append(hostids) or []
+    pages = collector.iter_item_pages()
+    next(pages)
+    assert len(fetched) <= 2  # next shards are requested as pages are consumed
+    assert len(list(pages)) == 5
+    assert len(fetched) == 6
+
+
+def test_failed_setup_does_not_leave_fetch_pool():
+    class UnavailableAPI(object):
+        def __getattr__(self, name):
+            raise IOError('Zabbix is not available')
+
+    collector = ZabbixCollector.__new__(ZabbixCollector)
+    collector.configure({'api_workers': 2})
+    collector.zapi = UnavailableAPI()
+    with pytest.raises(IOError):
+        collector.setup()
+    assert collector.pool is None
+
+
+def test_only_values_are_fetched_between_metadata_refreshes(zabbixserver, record_requests):
+    config = yaml.safe_load(open('tests/configs/explicit_config.yaml'))
+    collector = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo',
+                                metadata_refresh_interval=3600, **config)
+    full_scrape = [m.samples for m in collector.collect()]
+    assert sorted(collector.item_cache) == ['120', '123', '124', '126', '130']
+
+    requests = record_requests(collector)
+
+    assert [m.samples for m in collector.collect()] == full_scrape
+    assert [params['output'] for method, params in requests] == [['itemid', 'lastvalue', 'lastclock']]
+
+
+def test_hosts_added_after_startup_are_looked_up(zabbixserver, record_requests):
+    config = yaml.safe_load(open('tests/configs/explicit_config.yaml'))
+    collector = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', **config)
+    del collector.host_mapping.mapping['4']
+
+    requests = record_requests(collector)
+
+    metrics = list(collector.collect())
+    assert metrics[0].samples[0][1]['instance'] == 'rough-snowflake-web'
+    assert [(method, params.get('hostids')) for method, params in requests] == [
+        ('item.get', None), ('host.get', ['4'])]
+
+
+def test_hosts_added_after_startup_are_sharded(zabbixserver, record_requests):
+    collector = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', host_batch_size=1)
+    del collector.host_mapping.mapping['4']
+    requests = record_requests(collector)
+
+    list(collector.collect())
+    assert [(method, params.get('hostids')) for method, params in requests] == [
+        ('host.get', None), ('item.get', ['3']), ('item.get', ['4'])]
+
+
+def test_item_filters_are_derived_from_config(zabbixserver, record_requests):
+    config = yaml.safe_load(open('tests/configs/explicit_config.yaml'))
+    collector = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo',
+                                host_groups=['Databases', 'Web servers', 'Missing'], **config)
+    requests = record_requests(collector)
+
+    assert collector.host_mapping.params == {'groupids': ['9', '12']}
+    assert len(list(collector.collect())) == 4
+    assert requests[0] == ('item.get', {
+        'output': ['itemid', 'name', 'key_', 'hostid', 'lastvalue', 'lastclock', 'value_type'],
+        'sortfield': 'key_',
+        'filter': {'value_type': ['0', '3']},
+        'search': {'key_': ['local.metric[uwsgi,workers,*,*]', 'local.metric[uwsgi,sum,*,rss]',
+                            'local.metric[redis,*,*]', 'system.metric', 'zfs.total_bytes']},
+        'startSearch': True,
+        'searchByAny': True,
+        'searchWildcardsEnabled': True,
+        'groupids': ['9', '12'],
+    })
+
+    implicit = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo',
+                               hosts=['rough-snowflake-web'])
+    assert implicit.host_mapping.params == {'filter': {'host': ['rough-snowflake-web']}}
+    assert implicit.item_request(filtered=False) == {
+        'output': ['itemid', 'name', 'key_', 'hostid', 'lastvalue', 'lastclock', 'value_type'],
+        'sortfield': 'key_', 'hostids': ['3', '4']}  # fake server ignores host filter
+
+
+def test_shards_not_fetched_before_deadline_are_served_stale(zabbixserver):
+    from zabbix_exporter.core import exporter_registry
+
+    config = yaml.safe_load(open('tests/configs/explicit_config.yaml'))
+    collector = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo',
+                                host_batch_size=1, scrape_timeout=0.5, name='main', **config)
+    slow_hosts = set()
+    calls = []
+    fetch_items = collector.fetch_items
+
+    def fetch_host_items(hostids=None, output=None):
+        calls.append(tuple(hostids))
+        if slow_hosts.intersection(hostids):
+            time.sleep(1)
+        return [item for item in fetch_items(hostids, output) if item['hostid'] in hostids]
+    collector.fetch_items = fetch_host_items
+
+    fresh = [(m.name, m.samples) for m in collector.collect()]
+    assert exporter_registry.get_sample_value('zabbix_exporter_stale_shards', {'target': 'main'}) == 0
+
+    slow_hosts.add('4')
+    assert [(m.name, m.samples) for m in collector.collect()] == fresh
+    assert exporter_registry.get_sample_value('zabbix_exporter_stale_shards', {'target': 'main'}) == 1
+    assert exporter_registry.get_sample_value('zabbix_exporter_staleness_seconds', {'target': 'main'}) > 0
+
+    assert [(m.name, m.samples) for m in collector.collect()] == fresh
+    assert calls.count(('4',)) == 2  # still in flight, not requested again
+    assert all(set(item) == {'itemid', 'lastvalue', 'lastclock'} for metric, item in collector.merge_shards(
+        [(hostids, None) for hostids in collector.shard_cache], False))  # only values are kept
+
+    time.sleep(1)  # let request in flight finish
+    collector.shard_cache = {key: (samples, time.time() - 601) for key, (samples, fetched_at)
+                             in collector.shard_cache.items()}
+    stale = sum(len(m.samples) for m in collector.collect())
+    assert exporter_registry.get_sample_value('zabbix_exporter_stale_shards', {'target': 'main'}) == 1
+    assert stale < sum(len(samples) for name, samples in fresh)
+
+    time.sleep(1)
+    collector.shard_cache = {}
+    slow_hosts.add('3')
+    with pytest.raises(RuntimeError):
+        list(collector.collect())
+
+
+def test_collector_is_restored_from_snapshot(zabbixserver, tmpdir, record_requests):
+    from zabbix_exporter.core import MetricsCache
+    from zabbix_exporter.snapshot import Snapshot, config_fingerprint, save_snapshot
+
+    config = yaml.safe_load(open('tests/configs/explicit_config.yaml'))
+    collector = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo',
+                                metadata_refresh_interval=3600, **config)
+    samples = [m.samples for m in collector.collect()]
+    path = str(tmpdir.join('snapshot'))
+    fingerprint = config_fingerprint(dict(config, base_url=zabbixserver.url))
+    save_snapshot(path, collector, b'payload\n', saved_at=1460359130, fingerprint=fingerprint)
+
+    snapshot = Snapshot.load(path, fingerprint)
+    assert snapshot.payload == b'payload\n'
+    assert snapshot.saved_at == 1460359130
+    assert snapshot.items == collector.item_cache
+    restored = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', snapshot=snapshot,
+                               metadata_refresh_interval=3600, **config)
+    assert restored.host_mapping.mapping == collector.host_mapping.mapping
+
+    requests = record_requests(restored)
+
+    assert [m.samples for m in restored.collect()] == samples
+    assert [params['output'] for method, params in requests] == [['itemid', 'lastvalue', 'lastclock']]
+
+    cache = MetricsCache()
+    cache.restore(snapshot)
+    assert cache.payload == b'payload\n'
+
+    tmpdir.join('broken').write(b'ZBXSNAP1', mode='wb')
+    assert Snapshot.load(str(tmpdir.join('broken'))) is None
+    assert Snapshot.load(str(tmpdir.join('missing'))) is None
+
+    # snapshot of other Zabbix or rules is not restored, config changes apply after restart
+    renamed = dict(config, metrics=[dict(config['metrics'][0], name='uwsgi_workers_renamed')] + config['metrics'][1:])
+    assert Snapshot.load(path, config_fingerprint(dict(renamed, base_url=zabbixserver.url))) is None
+    assert Snapshot.load(path, config_fingerprint(dict(config, base_url='http://other.example.com'))) is None
+
+
+def test_target_serves_snapshot_while_zabbix_is_unavailable(tmpdir):
+    from zabbix_exporter.core import Target
+    from zabbix_exporter.snapshot import Snapshot, config_fingerprint
+
+    fingerprint = config_fingerprint({'base_url': 'http://zabbix.example.com'})
+    path = str(tmpdir.join('snapshot.main'))
+    with open(path, 'wb') as f:
+        f.write(Snapshot({}, {}, b'payload\n', saved_at=1460359130, fingerprint=fingerprint).dumps())
+    attempts = []
+
+    def unavailable(snapshot):
+        attempts.append(snapshot)
+        raise IOError('Zabbix is not available')
+
+    target = Target('main', unavailable, poll_interval=60, snapshot_path=path, fingerprint=fingerprint)
+    assert target.payload() == b'payload\n'
+    target._starting.join()
+    assert attempts[0].payload == b'payload\n'
+    other_config = Target('main', unavailable, poll_interval=60, snapshot_path=path,
+                          fingerprint=config_fingerprint({}))
+    assert other_config.metrics_cache.payload is None
+
+
+def test_rules_applied_by_process_pool_give_same_families(zabbixserver):
+    config = yaml.safe_load(open('tests/configs/explicit_config.yaml'))
+    items = json.load(open('tests/fixtures/items.get_success.json'))['result']
+    serial = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', **config)
+    parallel = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo',
+                               rule_processes=2, rule_chunk_size=2, **config)
+    try:
+        serial_cache, parallel_cache = {}, {}
+        expected = serial.assemble(serial.process_items(items, serial_cache))
+        families = parallel.assemble(parallel.process_items(items, parallel_cache))
+        assert parallel.rule_pool is not None
+    finally:
+        parallel.close()
+    assert parallel.rule_pool is None
+
+    assert [(f.name, f.documentation, f.samples) for f in families] == [
+        (f.name, f.documentation, f.samples) for f in expected]
+    assert parallel_cache == serial_cache
+    assert parallel.dropped == serial.dropped
+    assert [(r.matched, r.rejected) for r in parallel.rules] == [(r.matched, r.rejected) for r in serial.rules]
+
+
+def test_values_are_read_from_export_files(zabbixserver, tmpdir, record_requests):
+    from zabbix_exporter.export import ExportCollector
+
+    def export_line(itemid, value, clock):
+        return json.dumps({'host': {'host': 'host1', 'name': 'host1'}, 'groups': ['Linux servers'],
+                           'itemid': itemid, 'name': 'item', 'clock': clock, 'ns': 0, 'value': value,
+                           'type': 3}) + '\n'
+
+    def values(collector):
+        return {(s[0], s[1].get('status', s[1].get('port'))): (s[2], s[3])
+                for family in collector.collect() for s in family.samples}
+
+    config = yaml.safe_load(open('tests/configs/explicit_config.yaml'))
+    path = tmpdir.join('history-history-syncer-1.ndjson')
+    path.write(export_line(120, 1, 1460359000) + '{"itemid": 123, "clo')  # written before start
+    collector = ExportCollector(base_url=zabbixserver.url, login='demo', password='demo',
+                                export_dir=str(tmpdir), **config)
+    expected = values(ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', **config))
+
+    requests = record_requests(collector)
+
+    assert values(collector) == expected  # last values from item.get
+    assert [method for method, params in requests] == ['item.get']
+
+    path.write('ck": 1460359999, "value": 1}\n' + export_line(120, 11, 1460359200) + 'not json\n' +
+               export_line(123, 7, 1460359150)[:20], mode='a')
+    assert values(collector)[('redis_connected_clients', '6380')] == (11, 1460359200)
+    assert values(collector)[('uwsgi_workers', 'busy')] == (6, 1460359143)
+
+    # rotation: server finishes line in renamed file, then writes to new one
+    path.rename(str(tmpdir.join('history-history-syncer-1.ndjson.old')))
+    tmpdir.join('history-history-syncer-1.ndjson.old').write(export_line(123, 7, 1460359150)[20:], mode='a')
+    tmpdir.join('history-history-syncer-1.ndjson').write(
+        export_line(120, 12, 1460359300) + export_line(120, 10, 1460359100) + export_line(999, 5, 1460359300))
+    tmpdir.join('history-history-syncer-2.ndjson').write(export_line(126, 42, 1460359300))
+    result = values(collector)
+    assert result[('redis_connected_clients', '6380')] == (12, 1460359300)  # older value is ignored
+    assert result[('uwsgi_workers', 'busy')] == (7, 1460359150)
+    assert result[('uwsgi_rss', None)] == (42, 1460359300)
+    assert len(result) == len(expected)
+    assert '999' not in collector.export.values
+    assert [method for method, params in requests] == ['item.get']
+
+
+def test_database_collector_matches_api_collector(zabbixserver, tmpdir):
+    import sqlite3
+    from zabbix_exporter.database import DatabaseCollector
+
+    path = str(tmpdir.join('zabbix.db'))
+    db = sqlite3.connect(path)
+    db.executescript(open('tests/fixtures/zabbix_schema.sql').read())
+    for host in json.load(open('tests/fixtures/host.get_success.json'))['result']:
+        db.execute('INSERT INTO hosts (hostid, host, name) VALUES (?, ?, ?)',
+                   (host['hostid'], host['name'], host['name']))
+    db.execute("INSERT INTO hosts (hostid, host, name, status) VALUES (5, 'Template', 'Template', 3)")
+    db.execute("INSERT INTO items VALUES (200, 5, 'Template item', 'zfs.total_bytes', 3, 0, 0)")
+    for item in json.load(open('tests/fixtures/items.get_success.json'))['result']:
+        db.execute('INSERT INTO items (itemid, hostid, name, key_, value_type) VALUES (?, ?, ?, ?, ?)',
+                   (item['itemid'], item['hostid'], item['name'], item['key_'], item['value_type']))
+        table = {'1': 'history_str', '3': 'history_uint'}[item['value_type']]
+        db.execute('INSERT INTO %s VALUES (?, ?, ?, 0)' % table, (item['itemid'], item['lastclock'], item['lastvalue']))
+        db.execute('INSERT INTO %s VALUES (?, ?, ?, 0)' % table, (item['itemid'], int(item['lastclock']) - 60, '1'))
+    db.commit()
+    db.close()
+
+    config = yaml.safe_load(open('tests/configs/explicit_config.yaml'))
+    expected = ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', **config)
+    database = {'driver': 'sqlite3', 'connect': {'database': path, 'check_same_thread': False},
+                'history_period': 0, 'batch_size': 2}
+    collector = DatabaseCollector(database=database, host_batch_size=1, metadata_refresh_interval=3600, **config)
+    assert collector.host_mapping.mapping == expected.host_mapping.mapping
+
+    families = sorted((f.name, f.documentation, f.samples) for f in expected.collect())
+    assert sorted((f.name, f.documentation, f.samples) for f in collector.collect()) == families
+    assert sorted((f.name, f.documentation, f.samples) for f in collector.collect()) == families  # values only
+
+    api_items = json.load(open('tests/fixtures/items.get_success.json'))['result']
+    db_items = collector.zapi.item.get(output=['itemid', 'name', 'key_', 'hostid', 'lastvalue', 'lastclock',
+                                               'value_type'], sortfield='key_')
+    assert db_items == sorted(api_items, key=lambda item: item['key_'])
+    assert [item['itemid'] for item in collector.zapi.item.get(
+        output=['itemid'], search={'key_': ['local.metric[uwsgi,workers,*']}, startSearch=True,
+        searchWildcardsEnabled=True)] == ['123', '124', '125']
+
+
+def test_render_metric_escapes_labels_and_sorts_them():
+    family = MetricFamily('gauge', 'uwsgi_workers', 'UWSGI\nworkers', labels=['status', 'app'])
+    family.add_metric(['busy', 'my"app'], 6, 1460359143)
+    family.add_metric(['idle', 'back\\slash'], float('nan'))
+
+    assert render_metric(family) == (
+        b'# HELP uwsgi_workers UWSGI\\nworkers\n'
+        b'# TYPE uwsgi_workers gauge\n'
+        b'uwsgi_workers{app="my\\"app",status="busy"} 6.0 1460359143\n'
+        b'uwsgi_workers{app="back\\\\slash",status="idle"} NaN\n'
+    )
+
+
+def test_render_metric_keeps_only_series_of_last_render():
+    cache = {}
+    family = MetricFamily('gauge', 'uwsgi_workers', 'UWSGI workers', labels=['status'])
+    family.add_metric(['busy'], 6)
+    family.add_metric(['idle'], 2)
+    render_metric(family, cache)
+    assert set(cache[('uwsgi_workers', ('status',))]) == {('busy',), ('idle',)}
+
+    family = MetricFamily('gauge', 'uwsgi_workers', 'UWSGI workers', labels=['status'])
+    family.add_metric(['idle'], 3)
+    assert render_metric(family, cache).endswith(b'uwsgi_workers{status="idle"} 3.0\n')
+    assert set(cache[('uwsgi_workers', ('status',))]) == {('idle',)}
+
+
+def test_compat_waits_without_peek_and_acquire_timeout():
+    import socket
+    from zabbix_exporter.compat import acquire, wait_readable
+
+    class Python2Semaphore(object):
+        def __init__(self):
+            self.semaphore = threading.Semaphore(1)
+
+        def acquire(self, blocking=True):
+            return self.semaphore.acquire(blocking)
+
+    semaphore = Python2Semaphore()
+    assert acquire(semaphore, 0.05)
+    assert not acquire(semaphore, 0.05)
+
+    server, client = socket.socketpair()
+    try:
+        rfile = server.makefile('rb', 0)  # unbuffered, no peek like python 2 socket file
+        assert not hasattr(rfile, 'peek')
+        assert not wait_readable(rfile, server, 0.05)
+        client.sendall(b'GET / HTTP/1.1\r\n')
+        assert wait_readable(rfile, server, 0.05)
+        assert wait_readable(server.makefile('rb'), server, 0.05)
+    finally:
+        server.close()
+        client.close()
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding('gzip, deflate') == 'gzip'
+    assert negotiate_encoding('deflate, gzip;q=0') is None
+    assert negotiate_encoding('identity') is None
+    assert negotiate_encoding(None) is None
+
+
+def test_get_decoder():
+    assert get_decoder('json') is json.loads
+    assert get_decoder()(b'{"result": [1]}') == {'result': [1]}
+    with pytest.raises(ValueError):
+        get_decoder('simdjson')
+
+
+def test_expired_session_is_renewed_once_for_concurrent_calls():
+    from pytest_localserver.http import WSGIServer
+    from werkzeug.wrappers import Request, Response
+    from zabbix_exporter.api import ZabbixAPI, ZabbixAPIException
+
+    logins = []
+    valid_auth = ['token0']
+
+    def app(environ, start_response):
+        request = json.loads(Request(environ).get_data(as_text=True))
+        if request['method'] == 'user.login':
+            time.sleep(0.2)
+            logins.append(1)
+            response = {'result': 'token%d' % (len(logins) - 1)}
+        elif request['method'] == 'host.get':
+            response = {'error': {'code': -32500, 'message': 'Application error.', 'data': 'No permissions.'}}
+        elif request.get('auth') != valid_auth[0]:
+            response = {'error': {'code': -32602, 'message': 'Invalid params.',
+                                  'data': 'Session terminated, re-login, please.'}}
+        else:
+            response = {'result': []}
+        response.update(jsonrpc='2.0', id=request['id'])
+        return Response(json.dumps(response), content_type='application/json')(environ, start_response)
+
+    server = WSGIServer(application=app)
+    server.start()
+    try:
+        relogins = []
+        zapi = ZabbixAPI(server.url, on_relogin=lambda: relogins.append(1))
+        zapi.login('demo', 'demo')
+        assert zapi.item.get() == []
+
+        valid_auth[0] = 'token1'  # session expired on server side
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(zapi.item.get())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [[]] * 8
+        assert len(logins) == 2
+        assert len(relogins) == 1
+
+        with pytest.raises(ZabbixAPIException):
+            zapi.host.get()
+        assert len(logins) == 2
+    finally:
+        server.stop()
+
+
+def test_async_collector_matches_sync_collector(zabbixserver):
+    pytest.importorskip('aiohttp')
+    import asyncio
+    from zabbix_exporter.aio import AsyncExporter, AsyncZabbixCollector
+
+    config = yaml.safe_load(open('tests/configs/explicit_config.yaml'))
+    config['api_workers'] = 2
+    expected = list(ZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', **config).collect())
+    collector = AsyncZabbixCollector(base_url=zabbixserver.url, login='demo', password='demo', **config)
+    exporter = AsyncExporter({'zabbix': collector})
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(exporter.on_startup(None))
+        loop.run_until_complete(exporter._startup)
+        assert exporter.ready
+        assert loop.run_until_complete(exporter.refresh(['zabbix'])) == []
+        loop.run_until_complete(exporter.on_cleanup(None))
+    finally:
+        loop.close()
+
+    assert [(f.name, f.samples) for f in collector.collect()] == [(f.name, f.samples) for f in expected]
+
+
+def test_target_settings_inherit_top_level_options():
+    from zabbix_exporter.commands import target_settings
+
+    settings = {'url': None, 'login': 'demo', 'password': 'demo', 'verify_tls': True, 'timeout': 5,
+                'poll_interval': 0}
+    targets = target_settings(settings, {
+        'explicit_metrics': True,
+        'targets': [{'url': 'https://zabbix-1.example.com/', 'poll_interval': 30},
+                    {'name': 'second', 'url': 'https://zabbix-2.example.com', 'explicit_metrics': False}],
+    })
+    assert [(t['name'], t['poll_interval']) for t in targets] == [('zabbix-1.example.com', 30), ('second', 0)]
+    assert targets[0]['collector'] == {'base_url': 'https://zabbix-1.example.com', 'login': 'demo',
+                                       'password': 'demo', 'verify_tls': True, 'timeout': 5,
+                                       'explicit_metrics': True}
+    assert targets[1]['collector']['explicit_metrics'] is False
+
+
+def test_snapshot_is_rejected_with_async(tmpdir):
+    import click
+    from zabbix_exporter.commands import cli
+
+    with pytest.raises(click.UsageError):
+        cli(prog_name='zabbix_exporter', standalone_mode=False,
+            args=['--url', 'http://localhost:1', '--login', 'demo', '--password', 'demo', '--async',
+                  '--poll-interval', '60', '--snapshot', str(tmpdir.join('snapshot'))])
+
+
+def test_compression_level_is_validated():
+    import click
+    from zabbix_exporter.commands import cli
+
+    with pytest.raises(click.BadParameter):
+        cli(prog_name='zabbix_exporter', standalone_mode=False,
+            args=['--url', 'http://localhost:1', '--login', 'demo', '--password', 'demo', '--compression-level', '10'])
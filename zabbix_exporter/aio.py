@@ -0,0 +1,348 @@
+# coding: utf-8
+"""Asyncio variant of exporter, requires Python 3.5+ and aiohttp
+
+   All API calls of all collectors (host refresh, item shards, re-login)
+   run concurrently over one event loop, CPU-bound processing and rendering
+   are done in default executor so that event loop keeps serving requests.
+"""
+import asyncio
+import itertools
+import logging
+import time
+
+import aiohttp
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .api import ZabbixAPIException, get_decoder, is_auth_error, parse_response, request_body
+from .core import (ITEM_OUTPUT, VALUE_OUTPUT, HostCache, ZabbixCollector, api_bytes_total, api_relogins_total,
+                   api_requests_total, api_seconds_total, exporter_registry, scrapes_total, stage_seconds,
+                   startup_seconds, target_up)
+from .prometheus import generate_latest, render_metric
+from .utils import compress, negotiate_encoding
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSingleFlight(object):
+    """Runs coroutine function once for all concurrent callers, sharing its result (or exception)"""
+
+    def __init__(self):
+        self._future = None
+
+    async def do(self, func, *args):
+        if self._future is None:
+            self._future = asyncio.ensure_future(func(*args))
+            self._future.add_done_callback(self._reset)
+        return await asyncio.shield(self._future)
+
+    def _reset(self, future):
+        self._future = None
+
+
+class AsyncZabbixAPI(object):
+    """Minimal Zabbix JSON-RPC client over aiohttp session
+
+       Expired sessions are detected and renewed with single user.login
+       shared by all concurrent calls, failed call is retried once.
+    """
+
+    def __init__(self, base_url, login, password, session, decoder=None, timeout=None, verify_tls=True,
+                 observe_decode=None):
+        self.url = base_url + '/api_jsonrpc.php'
+        self.login_name = login
+        self.password = password
+        self.session = session
+        self.decoder = decoder or get_decoder()
+        self.observe_decode = observe_decode  # called with seconds spent decoding every response
+        self.timeout = aiohttp.ClientTimeout(total=timeout) if timeout else None
+        self.ssl = None if verify_tls else False
+        self.auth = ''
+        self._ids = itertools.count()
+        self._login = AsyncSingleFlight()
+
+    async def login(self):
+        self.auth = await self.request('user.login', {'user': self.login_name, 'password': self.password})
+
+    async def renew(self):
+        await self.login()
+        api_relogins_total.inc()
+
+    async def call(self, method, **params):
+        auth = self.auth
+        try:
+            return await self.request(method, params, auth)
+        except ZabbixAPIException as e:
+            if not is_auth_error(e):
+                raise
+            if self.auth == auth:  # session was not renewed by concurrent call yet
+                logger.info('Zabbix session expired, logging in again')
+                await self._login.do(self.renew)
+            return await self.request(method, params, self.auth)
+
+    async def request(self, method, params, auth=None):
+        started = time.time()
+        async with self.session.post(self.url, data=request_body(method, params, next(self._ids), auth),
+                                     headers={'Content-Type': 'application/json-rpc'},
+                                     timeout=self.timeout, ssl=self.ssl) as response:
+            response.raise_for_status()
+            content = await response.read()
+        api_requests_total.inc()
+        api_bytes_total.inc(len(content))
+        api_seconds_total.inc(time.time() - started)
+        if not content:
+            raise ZabbixAPIException('Received empty response')
+        return parse_response(content, self.decoder, self.observe_decode)['result']
+
+
+class AsyncZabbixCollector(ZabbixCollector):
+    """ZabbixCollector fetching from API with asyncio
+
+       `await refresh()` fetches hosts and item shards concurrently,
+       `collect()` returns families assembled by last refresh.
+    """
+
+    def __init__(self, base_url, login, password, verify_tls=True, timeout=None, **options):
+        self.configure(options)
+        self.base_url = base_url
+        self.credentials = (login, password)
+        self.verify_tls = verify_tls
+        self.timeout = timeout
+        self.zapi = None
+        self.host_mapping = HostCache(None)
+        self.hosts_updated_at = 0
+        self.families = []
+        self.updated_at = None  # when families were assembled last time
+        self._shards = None
+
+    async def start(self, session):
+        self.zapi = AsyncZabbixAPI(self.base_url, self.credentials[0], self.credentials[1], session,
+                                   decoder=get_decoder(self.options.get('json_decoder')),
+                                   timeout=self.timeout, verify_tls=self.verify_tls,
+                                   observe_decode=stage_seconds.labels(self.name, 'decode').observe)
+        self._shards = asyncio.Semaphore(self.api_workers)
+        await self.zapi.login()
+        if self.options.get('host_groups'):
+            self.groupids = self.find_groupids(await self.zapi.call('hostgroup.get', output=['groupid', 'name'],
+                                                                    filter={'name': self.options['host_groups']}))
+        self.host_mapping.params = self.host_params()
+        await self.refresh_hosts()
+        self.start_rule_pool()
+
+    async def refresh_hosts(self):
+        rows = await self.zapi.call('host.get', output=['hostid', 'name'], **self.host_mapping.params)
+        self.host_mapping.load(rows)
+        self.hosts_updated_at = time.time()
+
+    async def resolve_hosts(self, pages):
+        started = time.time()
+        unknown = self.host_mapping.unknown(item['hostid'] for items in pages for item in items)
+        if unknown:
+            rows = await self.zapi.call('host.get', output=['hostid', 'name'], hostids=sorted(unknown))
+            self.host_mapping.add(unknown, rows)
+        self.observe_stage('hosts', started)
+
+    async def fetch_items_async(self, hostids=None, output=ITEM_OUTPUT):
+        params = self.item_request(hostids, output)
+        async with self._shards:
+            started = time.time()
+            items = await self.zapi.call('item.get', **params)
+            self.observe_stage('api', started)
+        return items
+
+    async def refresh(self):
+        started = time.time()
+        host_refresh = None
+        host_refresh_interval = self.options.get('host_refresh_interval')
+        if host_refresh_interval and started - self.hosts_updated_at > host_refresh_interval:
+            host_refresh = asyncio.ensure_future(self.refresh_hosts())
+
+        values_only = self.item_cache_is_fresh()
+        output = VALUE_OUTPUT if values_only else ITEM_OUTPUT
+        if self.options.get('host_batch_size') or self.api_workers > 1:
+            if not values_only and not host_refresh_interval:
+                await self.refresh_hosts()  # see refresh_sharded_hosts
+            batches = self.host_batches()
+        else:
+            batches = [None]
+        shards = [asyncio.ensure_future(self.fetch_items_async(hostids, output)) for hostids in batches]
+        if self.options.get('scrape_timeout'):
+            pages = await self.wait_shards(shards, self.options['scrape_timeout'])
+        else:
+            pages = await asyncio.gather(*shards)
+        if host_refresh is not None:
+            await host_refresh
+        if not values_only:
+            await self.resolve_hosts([items for items in pages if items is not None])
+
+        loop = asyncio.get_event_loop()
+        self.families = await loop.run_in_executor(None, self.build_families, list(zip(batches, pages)), values_only)
+        self.updated_at = time.time()
+        self.observe_stage('collect', started)
+
+    async def wait_shards(self, shards, timeout):
+        """Items of every shard, None for shards not fetched within timeout"""
+        if shards:
+            await asyncio.wait(shards, timeout=timeout)
+        pages = []
+        for shard in shards:
+            if not shard.done():
+                shard.cancel()
+                pages.append(None)
+            elif shard.exception() is not None:
+                logger.warning('Failed to fetch items: %r', shard.exception())
+                pages.append(None)
+            else:
+                pages.append(shard.result())
+        return pages
+
+    def build_families(self, shards, values_only):
+        if self.options.get('scrape_timeout'):
+            return self.assemble(list(self.merge_shards(shards, values_only)))
+        if values_only:
+            return self.assemble(sample for hostids, items in shards for sample in self.cached_samples(items))
+        item_cache = {}
+        samples = [sample for hostids, items in shards for sample in self.process_items(items, item_cache)]
+        self.update_item_cache(item_cache)
+        return self.assemble(samples)
+
+    def collect(self):
+        return iter(self.families)
+
+
+class AsyncExporter(object):
+    """Serves metrics of several AsyncZabbixCollectors from one aiohttp application
+
+       /probe?target=NAME and /metrics/NAME - single collector, /metrics - `default` collectors
+       and exporter own metrics. Scrapes arriving during refresh share it, collectors with
+       poll interval are refreshed in background. One failing collector does not fail others.
+       Collectors connect to Zabbix after server starts listening, see /healthz and /ready.
+    """
+
+    def __init__(self, collectors, compression_level=0, default=None, poll_intervals=None, started_at=None):
+        self.collectors = collectors  # name -> AsyncZabbixCollector
+        self.compression_level = compression_level
+        self.default = list(collectors) if default is None else default
+        self.poll_intervals = poll_intervals or {}  # name -> seconds
+        self.refreshes = {name: AsyncSingleFlight() for name in collectors}
+        self.series_caches = {name: {} for name in collectors}  # rendered series prefixes, see render_metric
+        self.failed = set()  # collectors failed to start or to refresh last time
+        self.session = None
+        self.started_at = started_at or time.time()
+        self.ready = False
+        self._startup = None
+        self._pollers = []
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.router.add_get('/metrics/', self.handle_metrics)
+        app.router.add_get('/metrics/{name}', self.handle_metrics)
+        app.router.add_get('/probe', self.handle_metrics)
+        app.router.add_get('/healthz', self.handle_health)
+        app.router.add_get('/ready', self.handle_ready)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+    async def on_startup(self, app):
+        self.session = aiohttp.ClientSession()
+        self._startup = asyncio.ensure_future(self.start_collectors())
+
+    async def start_collectors(self):
+        names = list(self.collectors)
+        results = await asyncio.gather(*[self.collectors[name].start(self.session) for name in names],
+                                       return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.error('Failed to connect to target %s', name, exc_info=result)
+                self.failed.add(name)
+                target_up.labels(name).set(0)
+        self._pollers = [asyncio.ensure_future(self.poll(name, interval))
+                         for name, interval in self.poll_intervals.items()]
+        startup_seconds.set(time.time() - self.started_at)
+        self.ready = True
+
+    async def on_cleanup(self, app):
+        for task in [self._startup] + self._pollers:
+            task.cancel()
+        for collector in self.collectors.values():
+            collector.close()
+        await self.session.close()
+
+    async def poll(self, name, interval):
+        while True:
+            started = time.time()
+            await self.refresh([name])
+            await asyncio.sleep(max(interval - (time.time() - started), 0))
+
+    async def refresh_collector(self, name):
+        collector = self.collectors[name]
+        if collector.zapi is None or name in self.failed and collector.updated_at is None:
+            await collector.start(self.session)  # Zabbix was not available on startup
+        await collector.refresh()
+
+    async def refresh(self, names):
+        """Refreshes collectors concurrently, returns names of failed ones"""
+        results = await asyncio.gather(*[self.refreshes[name].do(self.refresh_collector, name) for name in names],
+                                       return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.error('Fetch from %s failed', name, exc_info=result)
+                self.failed.add(name)
+            else:
+                self.failed.discard(name)
+            target_up.labels(name).set(0 if name in self.failed else 1)
+        return [name for name in names if name in self.failed]
+
+    def render(self, names, exporter_metrics):
+        payload = b''.join(render_metric(family, self.series_caches[name]) for name in names
+                           for family in itertools.chain(self.collectors[name].collect(),
+                                                         self.collectors[name].rule_stats.collect()))
+        if exporter_metrics:
+            payload += generate_latest(exporter_registry)
+        return payload
+
+    async def handle_health(self, request):
+        return web.Response(text='OK\n')
+
+    async def handle_ready(self, request):
+        if not self.ready:
+            return web.Response(status=503, text='Starting\n')
+        return web.Response(text='OK\n')
+
+    async def handle_metrics(self, request):
+        if not self.ready:
+            return web.Response(status=503, text='Exporter is starting\n')
+        scrapes_total.inc()
+        name = request.match_info.get('name')
+        if request.path.rstrip('/') == '/probe':
+            name = request.query.get('target', '')
+        if name is not None and name not in self.collectors:
+            raise web.HTTPNotFound(text='Unknown target\n')
+        names = [name] if name is not None else self.default
+
+        await self.refresh([n for n in names if n not in self.poll_intervals])
+        # polled collectors keep serving last collected metrics when refresh fails
+        available = [n for n in names if n not in self.failed or
+                     n in self.poll_intervals and self.collectors[n].updated_at is not None]
+        if names and not available:
+            return web.Response(status=500)
+        if any(self.collectors[n].updated_at is None for n in available):
+            return web.Response(status=503, text='Metrics are not collected yet\n')
+
+        loop = asyncio.get_event_loop()
+        started = time.time()
+        body = await loop.run_in_executor(None, self.render, available, name is None)
+        headers = {'Content-Type': CONTENT_TYPE_LATEST}
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding')) if self.compression_level else None
+        if encoding:
+            body = await loop.run_in_executor(None, compress, body, encoding, self.compression_level)
+            headers['Content-Encoding'] = encoding
+            headers['Vary'] = 'Accept-Encoding'
+        stage_seconds.labels(name if name is not None else ','.join(names), 'render').observe(time.time() - started)
+        return web.Response(body=body, headers=headers)
+
+
+def serve(exporter, port):
+    web.run_app(exporter.make_app(), port=port, print=None)
@@ -0,0 +1,133 @@
+# coding: utf-8
+"""Zabbix API client with pluggable JSON decoding and session renewal
+
+   Responses of item.get are the largest thing exporter handles, so they are decoded
+   straight from response bytes with the fastest available decoder (orjson, ujson, stdlib json).
+   Expired sessions are renewed with single user.login shared by all concurrent calls.
+"""
+import json
+import logging
+import time
+
+import pyzabbix
+from pyzabbix import ZabbixAPIException
+
+from .utils import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+def _available_decoders():
+    decoders = {'json': json.loads}
+    try:
+        import ujson
+        decoders['ujson'] = ujson.loads
+    except ImportError:
+        pass
+    try:
+        import orjson
+        decoders['orjson'] = orjson.loads
+    except ImportError:
+        pass
+    return decoders
+
+
+DECODERS = _available_decoders()
+
+
+def get_decoder(name=None):
+    """Returns JSON decoder by name, or the fastest installed one"""
+    if name is None:
+        for name in ('orjson', 'ujson', 'json'):
+            if name in DECODERS:
+                break
+    if name not in DECODERS:
+        raise ValueError('JSON decoder %s is not installed' % name)
+    return DECODERS[name]
+
+
+class ZabbixAPI(pyzabbix.ZabbixAPI):
+
+    def __init__(self, server, decoder=None, observe_decode=None, on_relogin=None, **kwargs):
+        super(ZabbixAPI, self).__init__(server, **kwargs)
+        self.decoder = decoder or get_decoder()
+        self.observe_decode = observe_decode  # called with seconds spent decoding every response
+        self.on_relogin = on_relogin  # called every time expired session is renewed
+        self.credentials = None
+        self._relogin = SingleFlight()
+
+    def login(self, user='', password=''):
+        self.credentials = (user, password)
+        # new token replaces old one only when ready, concurrent calls never go without auth
+        self.auth = self.send_request('user.login', {'user': user, 'password': password})['result']
+
+    def relogin(self, expired_auth):
+        """Renews session once for all concurrent calls failed with `expired_auth`"""
+        if self.auth == expired_auth:  # not renewed by concurrent call yet
+            self._relogin.do(self._renew)
+
+    def _renew(self):
+        self.login(*self.credentials)
+        if self.on_relogin is not None:
+            self.on_relogin()
+
+    def do_request(self, method, params=None):
+        auth = self.auth
+        try:
+            return self.send_request(method, params, auth)
+        except ZabbixAPIException as e:
+            if method == 'user.login' or self.credentials is None or not is_auth_error(e):
+                raise
+            logger.info('Zabbix session expired, logging in again')
+            self.relogin(auth)
+            return self.send_request(method, params, self.auth)
+
+    def send_request(self, method, params=None, auth=None):
+        response = self.session.post(self.url, data=request_body(method, params, self.id, auth),
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        if not len(response.content):
+            raise ZabbixAPIException('Received empty response')
+
+        self.id += 1
+        return parse_response(response.content, self.decoder, self.observe_decode)
+
+
+def request_body(method, params, request_id, auth=None):
+    request_json = {
+        'jsonrpc': '2.0',
+        'method': method,
+        'params': params or {},
+        'id': request_id,
+    }
+    if auth and method not in ('apiinfo.version', 'user.checkAuthentication'):
+        request_json['auth'] = auth
+    return json.dumps(request_json)
+
+
+def parse_response(content, decoder, observe_decode=None):
+    """Decodes JSON-RPC response, raising ZabbixAPIException for API errors"""
+    started = time.time()
+    try:
+        response_json = decoder(content)
+    except ValueError:
+        raise ZabbixAPIException('Unable to parse json: %r' % content[:1000])
+    if observe_decode is not None:
+        observe_decode(time.time() - started)
+
+    if 'error' in response_json:
+        error = response_json['error']
+        msg = u'Error {code}: {message}, {data}'.format(
+            code=error['code'],
+            message=error['message'],
+            data=error.get('data', 'No data')  # some errors don't contain 'data': workaround for ZBX-9340
+        )
+        raise ZabbixAPIException(msg, error['code'])
+    return response_json
+
+
+def is_auth_error(exc):
+    """Whether API error means that session is expired or invalid, and re-login is needed"""
+    message = str(exc.args[0] if exc.args else '').lower()
+    return any(reason in message for reason in ('re-login', 'not authorised', 'not authorized',
+                                                'session terminated'))
@@ -1,14 +1,14 @@
 # coding: utf-8
 import logging
+import time
+from collections import OrderedDict
+from functools import partial
 
 import click
 import sys
-import yaml
-from prometheus_client import REGISTRY
 
 import zabbix_exporter
-from zabbix_exporter.core import ZabbixCollector, MetricsHandler
-from .compat import HTTPServer
+from zabbix_exporter.compat import urlparse
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +35,22 @@ def validate_settings(settings):
 @click.option('--password', help='Zabbix password')
 @click.option('--verify-tls/--no-verify', help='Enable TLS cert verification [default: true]', default=True)
 @click.option('--timeout', help='API read/connect timeout', default=5)
+@click.option('--poll-interval', default=0,
+              help='Refresh metrics in background every N seconds and serve cached payload '
+                   '[default: 0, fetch on every scrape]')
+@click.option('--workers', default=16,
+              help='Maximum number of concurrently served HTTP requests [default: 16]')
+@click.option('--stream', is_flag=True,
+              help='Stream metrics with chunked encoding as they are rendered, instead of buffering whole response')
+@click.option('--compression-level', default=6, type=click.IntRange(0, 9),
+              help='Compress responses with gzip (or zstd) when scraper accepts it, 0 to disable [default: 6]')
+@click.option('--enable-profiling', is_flag=True,
+              help='Serve /debug/profile?scrapes=N endpoint with cProfile stats of N collections')
+@click.option('--snapshot', type=click.Path(dir_okay=False),
+              help='Save state to this file after every background refresh and restore it on start, '
+                   'requires --poll-interval')
+@click.option('--async', 'use_async', is_flag=True,
+              help='Serve with asyncio event loop instead of thread per connection (Python 3.5+, requires aiohttp)')
 @click.option('--verbose', is_flag=True)
 @click.option('--dump-metrics', help='Output all metrics for human to write yaml config', is_flag=True)
 @click.option('--version', is_flag=True)
@@ -69,14 +85,16 @@ def cli(**settings):
         click.echo('Version %s' % zabbix_exporter.__version__)
         return
 
-    if not validate_settings(settings):
-        return
-
+    started_at = time.time()
     if settings['config']:
+        import yaml
         exporter_config = yaml.safe_load(open(settings['config']))
     else:
         exporter_config = {}
 
+    if 'targets' not in exporter_config and 'database' not in exporter_config and not validate_settings(settings):
+        return
+
     base_logger = logging.getLogger('zabbix_exporter')
     handler = logging.StreamHandler()
     base_logger.addHandler(handler)
@@ -85,38 +103,180 @@ def cli(**settings):
     if settings['verbose']:
         base_logger.setLevel(logging.DEBUG)
 
-    collector = ZabbixCollector(
-        base_url=settings['url'].rstrip('/'),
-        login=settings['login'],
-        password=settings['password'],
-        verify_tls=settings['verify_tls'],
-        timeout=settings['timeout'],
-        **exporter_config
-    )
+    targets = target_settings(settings, exporter_config)
+    if settings['snapshot'] and not any(target['poll_interval'] for target in targets):
+        raise click.UsageError('--snapshot requires --poll-interval')
 
     if settings['dump_metrics']:
-        return dump_metrics(collector)
+        for target in targets:
+            dump_metrics(collector_class(target['collector'])(**target['collector']))
+        return
 
-    REGISTRY.register(collector)
-    httpd = HTTPServer(('', int(settings['port'])), MetricsHandler)
-    click.echo('Exporter for {base_url}, user: {login}, password: ***'.format(
-        base_url=settings['url'].rstrip('/'),
-        login=settings['login'],
-        password=settings['password']
-    ))
+    if settings['use_async']:
+        if any(target['collector'].get(option) for target in targets for option in ('export_dir', 'database')):
+            raise click.UsageError('export_dir and database are not supported with --async')
+        if settings['snapshot']:
+            raise click.UsageError('--snapshot is not supported with --async')
+        return serve_async(settings, targets, multi_target='targets' in exporter_config, started_at=started_at)
+
+    # listen right away, connecting to Zabbix happens in background
+    from zabbix_exporter.core import ExporterServer, MetricsHandler, Startup
+    httpd = ExporterServer(('', int(settings['port'])), MetricsHandler, max_workers=int(settings['workers']))
+    httpd.stream = settings['stream']
+    httpd.compression_level = int(settings['compression_level'])
+    httpd.profiling = settings['enable_profiling']
+    if 'targets' not in exporter_config:
+        httpd.name = targets[0]['name']
+    # metrics restored from snapshot are served while exporter connects to Zabbix
+    if 'targets' in exporter_config:
+        httpd.targets = make_targets(settings, targets)
+        setup = partial(start_targets, httpd)
+    else:
+        setup = partial(setup_collector, httpd, settings, targets[0], setup_cache(httpd, settings, targets[0]))
+    httpd.startup = Startup(setup, started_at=started_at)
+    httpd.startup.start()
+    for target in targets:
+        click.echo(describe_target(target))
     if settings['return_server']:
         return httpd
     click.echo('Exporting Zabbix metrics on http://0.0.0.0:{}'.format(settings['port']))
     httpd.serve_forever()
 
 
+def setup_cache(httpd, settings, target):
+    """Creates metrics cache of polled exporter, serving snapshot right away; returns restored snapshot"""
+    from prometheus_client import REGISTRY
+    from zabbix_exporter.core import MetricsCache
+    from zabbix_exporter.snapshot import Snapshot, config_fingerprint
+
+    if not settings['poll_interval']:
+        return None
+    httpd.metrics_cache = MetricsCache(REGISTRY, interval=int(settings['poll_interval']), name=target['name'])
+    if settings['snapshot']:
+        snapshot = Snapshot.load(settings['snapshot'], config_fingerprint(target['collector']))
+        httpd.metrics_cache.restore(snapshot)
+        return snapshot
+
+
+def setup_collector(httpd, settings, target, snapshot=None):
+    from prometheus_client import REGISTRY
+    from zabbix_exporter.snapshot import config_fingerprint, save_snapshot
+
+    collector = collector_class(target['collector'])(snapshot=snapshot, name=target['name'], **target['collector'])
+    REGISTRY.register(collector)
+    REGISTRY.register(collector.rule_stats)
+    httpd.collector = collector
+    if httpd.metrics_cache is not None:
+        if settings['snapshot']:
+            httpd.metrics_cache.on_refresh = partial(save_snapshot, settings['snapshot'], collector,
+                                                     fingerprint=config_fingerprint(target['collector']))
+        httpd.metrics_cache.start()
+
+
+def make_targets(settings, targets):
+    """name -> Target, polled targets serve their snapshots right away"""
+    from zabbix_exporter.core import Target
+    from zabbix_exporter.snapshot import config_fingerprint
+
+    def snapshot_path(target):
+        if settings['snapshot']:
+            return '%s.%s' % (settings['snapshot'], target['name'])
+
+    return OrderedDict(
+        (target['name'], Target(target['name'], partial(collector_class(target['collector']), name=target['name'],
+                                                        **target['collector']),
+                                poll_interval=target['poll_interval'], snapshot_path=snapshot_path(target),
+                                fingerprint=config_fingerprint(target['collector'])))
+        for target in targets)
+
+
+def start_targets(httpd):
+    from multiprocessing.pool import ThreadPool
+    from zabbix_exporter.core import Target
+
+    # log in to all targets concurrently, unavailable ones are retried on scrape
+    pool = ThreadPool(len(httpd.targets))
+    pool.map(Target.start, httpd.targets.values())
+    pool.close()
+
+
+def collector_class(options):
+    """Collector reading values from real-time export files with `export_dir`,
+       from Zabbix database with `database`, from API otherwise
+    """
+    if options.get('database'):
+        from zabbix_exporter.database import DatabaseCollector
+        return DatabaseCollector
+    if options.get('export_dir'):
+        from zabbix_exporter.export import ExportCollector
+        return ExportCollector
+    from zabbix_exporter.core import ZabbixCollector
+    return ZabbixCollector
+
+
+def describe_target(target):
+    collector = target['collector']
+    if collector.get('database'):
+        return 'Exporter for {name}, database driver: {driver}'.format(name=target['name'], **collector['database'])
+    return 'Exporter for {base_url}, user: {login}, password: ***'.format(**collector)
+
+
+def target_settings(settings, exporter_config):
+    """Settings of every Zabbix target: name, poll_interval and ZabbixCollector arguments
+
+       Without `targets` in config single target is taken from command line.
+       Target entries may override any top level option, command line settings are defaults.
+    """
+    options = dict((key, value) for key, value in exporter_config.items() if key != 'targets')
+    targets = []
+    for target in exporter_config.get('targets') or [{}]:
+        target = dict(target)
+        url = target.pop('url', settings['url'])
+        login, password = target.get('login', settings['login']), target.get('password', settings['password'])
+        if not (url and login and password) and not target.get('database', options.get('database')):
+            raise click.UsageError('Please provide url, login and password (or database) of every target')
+        base_url = url.rstrip('/') if url else None
+        collector = dict(options)
+        collector.update(
+            base_url=base_url,
+            login=target.pop('login', settings['login']),
+            password=target.pop('password', settings['password']),
+            verify_tls=target.pop('verify_tls', settings['verify_tls']),
+            timeout=target.pop('timeout', settings['timeout']),
+        )
+        name = str(target.pop('name', urlparse(base_url).netloc if base_url else 'database'))
+        poll_interval = int(target.pop('poll_interval', settings['poll_interval']))
+        collector.update(target)
+        targets.append({'name': name, 'poll_interval': poll_interval, 'collector': collector})
+    if len(set(target['name'] for target in targets)) != len(targets):
+        raise click.UsageError('Target names should be unique')
+    return targets
+
+
+def serve_async(settings, targets, multi_target=False, started_at=None):
+    from zabbix_exporter.aio import AsyncExporter, AsyncZabbixCollector, serve
+
+    collectors = OrderedDict((target['name'], AsyncZabbixCollector(name=target['name'], **target['collector']))
+                             for target in targets)
+    poll_intervals = dict((target['name'], target['poll_interval']) for target in targets if target['poll_interval'])
+    exporter = AsyncExporter(collectors, int(settings['compression_level']),
+                             default=[] if multi_target else list(collectors), poll_intervals=poll_intervals,
+                             started_at=started_at)
+    for target in targets:
+        click.echo(describe_target(target))
+    if settings['return_server']:
+        return exporter.make_app()
+    click.echo('Exporting Zabbix metrics on http://0.0.0.0:{}'.format(settings['port']))
+    serve(exporter, int(settings['port']))
+
+
 def dump_metrics(collector):
-    for item in collector.zapi.item.get(output=['name', 'key_', 'hostid', 'lastvalue', 'lastclock', 'value_type'],
-                                        sortfield='key_'):
-        click.echo('{host:20}{key} = {value}\n{name:>20}'.format(
-            host=collector.host_mapping.get(item['hostid'], item['hostid']),
-            key=item['key_'],
-            value=item['lastvalue'],
-            name=item['name']
-        ))
+    for items in collector.iter_item_pages(filtered=False):
+        for item in items:
+            click.echo('{host:20}{key} = {value}\n{name:>20}'.format(
+                host=collector.host_mapping.get(item['hostid'], item['hostid']),
+                key=item['key_'],
+                value=item['lastvalue'],
+                name=item['name']
+            ))
     return
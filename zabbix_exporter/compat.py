@@ -1,10 +1,64 @@
 # flake8: noqa
+import select
+import socket
+import time
+
 try:
     from http.server import HTTPServer, BaseHTTPRequestHandler
 except ImportError:
     from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
 try:
     import io as StringIO
 except ImportError:
     import StringIO
+
+try:
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from urlparse import parse_qs, urlparse
+
+try:
+    from sys import intern
+except ImportError:
+    intern = intern
+
+try:
+    from itertools import izip as zip
+except ImportError:
+    zip = zip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def wait_readable(rfile, connection, timeout):
+    """Whether data to read from `rfile` of `connection` socket (or its end) arrives within `timeout` seconds"""
+    if not hasattr(rfile, 'peek'):  # python 2 socket._fileobject
+        return bool(select.select([connection], [], [], timeout)[0])
+    connection.settimeout(timeout)
+    try:
+        return bool(rfile.peek(1))
+    except socket.timeout:
+        return False
+
+
+def acquire(semaphore, timeout):
+    """semaphore.acquire(timeout=timeout), python 2 semaphores do not support timeout"""
+    try:
+        return semaphore.acquire(timeout=timeout)
+    except TypeError:
+        pass
+    deadline = time.time() + timeout
+    while not semaphore.acquire(False):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
@@ -1,14 +1,25 @@
 # coding: utf-8
+import codecs
+import cProfile
+import io
 import logging
-import re
-from collections import OrderedDict
+import math
+import multiprocessing
+import pstats
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from itertools import chain
 
-import pyzabbix
-from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, CollectorRegistry
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, CollectorRegistry
 
-from .compat import BaseHTTPRequestHandler
-from .prometheus import MetricFamily, generate_latest
-from .utils import SortedDict
+from .compat import BaseHTTPRequestHandler, HTTPServer, ThreadingMixIn, acquire, parse_qs, urlparse, wait_readable
+from .prometheus import MetricFamily, collect, generate_latest, iter_latest
+from .rules import RuleSet, prepare_regex, sanitize_key  # noqa
+from .snapshot import Snapshot, save_snapshot
+from .utils import SingleFlight, SortedDict, compress, compressobj, negotiate_encoding  # noqa
 
 logger = logging.getLogger(__name__)
 
@@ -17,28 +28,156 @@ exporter_registry = CollectorRegistry()  # makes sure to collect metrics after Z
 
 scrapes_total = Counter('zabbix_exporter_scrapes_total', 'Number of scrapes', registry=exporter_registry)
 api_requests_total = Counter('zabbix_exporter_api_requests_total', 'Requests to Zabbix API', registry=exporter_registry)
-api_bytes_total = Counter('zabbix_exporter_api_bytes_total', 'Bytes in response from Zabbix API (after decompression)', registry=exporter_registry)
-api_seconds_total = Counter('zabbix_exporter_api_seconds_total', 'Seconds spent fetching from Zabbix API', registry=exporter_registry)
-metrics_count_total = Gauge('zabbix_exporter_metrics_total', 'Number of exported zabbix metrics', registry=exporter_registry)
-series_count_total = Gauge('zabbix_exporter_series_total', 'Number of exported zabbix values', registry=exporter_registry)
+api_bytes_total = Counter('zabbix_exporter_api_bytes_total', 'Bytes in response from Zabbix API (after decompression)',
+                          registry=exporter_registry)
+api_relogins_total = Counter('zabbix_exporter_api_relogins_total', 'Zabbix API sessions renewed after expiry',
+                             registry=exporter_registry)
+api_seconds_total = Counter('zabbix_exporter_api_seconds_total', 'Seconds spent fetching from Zabbix API',
+                            registry=exporter_registry)
+metrics_count_total = Gauge('zabbix_exporter_metrics_total', 'Number of exported zabbix metrics', ['target'],
+                            registry=exporter_registry)
+series_count_total = Gauge('zabbix_exporter_series_total', 'Number of exported zabbix values', ['target'],
+                           registry=exporter_registry)
+snapshot_age_seconds = Gauge('zabbix_exporter_snapshot_age_seconds', 'Seconds since cached metrics were refreshed',
+                             ['target'], registry=exporter_registry)
+refresh_seconds = Gauge('zabbix_exporter_refresh_duration_seconds', 'Duration of last background metrics refresh',
+                        ['target'], registry=exporter_registry)
+refresh_failures_total = Counter('zabbix_exporter_refresh_failures_total', 'Failed background metrics refreshes',
+                                 ['target'], registry=exporter_registry)
+stage_seconds = Histogram('zabbix_exporter_stage_seconds',
+                          'Seconds spent in scrape stages (render includes collect, collect includes api/hosts/rules, '
+                          'api includes decode)',
+                          ['target', 'stage'], buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, float('inf')),
+                          registry=exporter_registry)
+stale_shards = Gauge('zabbix_exporter_stale_shards',
+                     'Item shards not fetched before scrape deadline, served from earlier scrape', ['target'],
+                     registry=exporter_registry)
+staleness_seconds = Gauge('zabbix_exporter_staleness_seconds', 'Age of oldest item values served by last scrape',
+                          ['target'], registry=exporter_registry)
+startup_seconds = Gauge('zabbix_exporter_startup_duration_seconds',
+                        'Seconds from process start until exporter got ready', registry=exporter_registry)
+target_up = Gauge('zabbix_exporter_target_up', 'Whether last collection from target succeeded', ['target'],
+                  registry=exporter_registry)
 
 
-def sanitize_key(string):
-    return re.sub('[^a-zA-Z0-9:_]+', '_', string)
+class RuleStatsCollector(object):
+    """Exports per-rule match/reject and dropped items counters of one ZabbixCollector
 
+       Registered in the same registry as its collector, so that every target has own counters.
+    """
 
-def prepare_regex(key_pattern):
-    return re.escape(key_pattern).replace('\*', '([^,]*?)')
+    def __init__(self, collector):
+        self.collector = collector
+
+    def collect(self):
+        matched = MetricFamily('counter', 'zabbix_exporter_rule_matches_total', 'Items matched by metric rule',
+                               labels=['rule'])
+        rejected = MetricFamily('counter', 'zabbix_exporter_rule_rejects_total', 'Items rejected by metric rule',
+                                labels=['rule'])
+        dropped = MetricFamily('counter', 'zabbix_exporter_items_dropped_total', 'Items not exported',
+                               labels=['reason'])
+        for rule in self.collector.rules:
+            matched.add_metric([rule.key], rule.matched)
+            rejected.add_metric([rule.key], rule.rejected)
+        dropped_counts = self.collector.dropped
+        for reason in sorted(dropped_counts):
+            dropped.add_metric([reason], dropped_counts[reason])
+        return [matched, rejected, dropped]
+
+
+ITEM_OUTPUT = ['itemid', 'name', 'key_', 'hostid', 'lastvalue', 'lastclock', 'value_type']
+VALUE_OUTPUT = ['itemid', 'lastvalue', 'lastclock']
+IMPLICIT_LABELNAMES = ('instance',)
+EXPORTABLE_VALUE_TYPES = ['0', '3']  # numeric float, numeric unsigned
+
+
+class HostCache(object):
+    """hostid -> host name mapping
+
+       Whole mapping is reloaded by background thread every `interval` seconds,
+       hosts added in between are looked up on demand with one batched host.get.
+    """
+
+    def __init__(self, zapi, params=None):
+        self.zapi = zapi
+        self.params = params or {}  # host.get selectors (groupids, filter) for full refresh
+        self.mapping = {}
+        self.missing = set()  # hostids unknown to zabbix, not looked up again until refresh
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __getitem__(self, hostid):
+        return self.mapping.get(hostid, hostid)
+
+    def __contains__(self, hostid):
+        return hostid in self.mapping
+
+    def __iter__(self):
+        return iter(self.mapping)
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def get(self, hostid, default=None):
+        return self.mapping.get(hostid, default)
+
+    def refresh(self):
+        self.load(self.zapi.host.get(output=['hostid', 'name'], **self.params))
+
+    def load(self, rows):
+        """Replaces whole mapping with host.get result rows"""
+        self.mapping = {row['hostid']: row['name'] for row in rows}
+        self.missing = set()
+
+    def resolve(self, hostids):
+        """Looks up hostids which are not in mapping yet"""
+        unknown = self.unknown(hostids)
+        if unknown:
+            self.add(unknown, self.zapi.host.get(output=['hostid', 'name'], hostids=sorted(unknown)))
+
+    def unknown(self, hostids):
+        mapping = self.mapping
+        return {hostid for hostid in hostids if hostid not in mapping} - self.missing
+
+    def add(self, requested, rows):
+        """Adds host.get result rows for `requested` hostids to mapping"""
+        found = {row['hostid']: row['name'] for row in rows}
+        logger.debug('Found %d of %d new hosts', len(found), len(requested))
+        updated = dict(self.mapping)
+        updated.update(found)
+        self.mapping = updated
+        self.missing |= set(requested) - set(found)
+
+    def start(self, interval):
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='host-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Host mapping refresh failed')
 
 
 class ZabbixCollector(object):
 
-    def __init__(self, base_url, login, password, verify_tls=True, timeout=None, **options):
-        self.options = options
-        self.key_patterns = {prepare_regex(metric['key']): metric
-                             for metric in options.get('metrics', [])}
+    def __init__(self, base_url, login, password, verify_tls=True, timeout=None, snapshot=None, **options):
+        # API client and its dependencies are imported only when exporter connects to Zabbix
+        from requests.adapters import HTTPAdapter
+        from .api import ZabbixAPI, get_decoder
+
+        self.configure(options)
 
-        self.zapi = pyzabbix.ZabbixAPI(base_url, timeout=timeout)
+        self.zapi = ZabbixAPI(base_url, timeout=timeout, decoder=get_decoder(options.get('json_decoder')),
+                              observe_decode=stage_seconds.labels(self.name, 'decode').observe,
+                              on_relogin=api_relogins_total.inc)
         if not verify_tls:
             import requests.packages.urllib3 as urllib3
             urllib3.disable_warnings()
@@ -50,110 +189,844 @@ class ZabbixCollector(object):
             api_seconds_total.inc(r.elapsed.total_seconds())
         self.zapi.session.hooks = {'response': measure_api_request}
 
+        if self.api_workers > 1:
+            adapter = HTTPAdapter(pool_maxsize=self.api_workers)
+            self.zapi.session.mount('http://', adapter)
+            self.zapi.session.mount('https://', adapter)
+
         self.zapi.login(login, password)
+        self.setup(snapshot)
+
+    def setup(self, snapshot=None):
+        """Sets up everything after connecting to Zabbix: host groups, host mapping and fetch pool
 
-        self.host_mapping = {row['hostid']: row['name']
-                             for row in self.zapi.host.get(output=['hostid', 'name'])}
+           Pools are created once hosts are loaded, so that failed attempt retried by Startup leaves nothing behind.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        options = self.options
+        if options.get('host_groups'):
+            self.groupids = self.find_groupids(self.zapi.hostgroup.get(output=['groupid', 'name'],
+                                                                       filter={'name': options['host_groups']}))
+        self.host_mapping = HostCache(self.zapi, self.host_params())
+        if snapshot is not None:
+            snapshot.restore(self)  # hosts unknown to snapshot are looked up on demand
+        else:
+            self.host_mapping.refresh()
+        if self.api_workers > 1 or options.get('scrape_timeout'):
+            self.pool = ThreadPool(self.api_workers)
+        self.start_rule_pool()
+        if options.get('host_refresh_interval'):
+            self.host_mapping.start(options['host_refresh_interval'])
+
+    def start_rule_pool(self):
+        """Starts worker processes applying rules with `rule_processes`"""
+        if self.options.get('rule_processes', 1) > 1 and self.rule_pool is None:
+            from .parallel import RulePool
+            self.rule_pool = RulePool(self.options, self.options['rule_processes'],
+                                      self.options.get('rule_chunk_size', 5000))
+
+    def close(self):
+        """Stops rule worker processes and fetch threads"""
+        if self.rule_pool is not None:
+            self.rule_pool.close()
+            self.rule_pool = None
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def configure(self, options):
+        """Sets up everything not related to API connection"""
+        self.name = options.pop('name', '')  # target name, label of exporter own metrics
+        self.options = options
+        self.rules = RuleSet(options.get('metrics', []))
+        self.dropped = {'unsupported': 0, 'implicit': 0}
+        self.rule_stats = RuleStatsCollector(self)  # registered next to collector
+        self.api_workers = options.get('api_workers', 1)
+        self.pool = None
+        self.item_cache = {}  # itemid -> processed metric
+        self.item_cache_updated_at = 0
+        self.groupids = None  # resolved from `host_groups` names
+        # hostids -> ([(metric, itemid, lastvalue, lastclock)], fetched_at), fallback for shards not fetched in time
+        self.shard_cache = {}
+        self.in_flight = {}  # hostids -> (output, AsyncResult) of shards not fetched before last deadline
+        self.rule_pool = None  # worker processes applying rules, with `rule_processes`
+
+    def find_groupids(self, rows):
+        found = {row['name']: row['groupid'] for row in rows}
+        missing = set(self.options['host_groups']) - set(found)
+        if missing:
+            logger.warning('Host groups not found: %s', ', '.join(sorted(missing)))
+        return sorted(found.values(), key=int)
+
+    def host_params(self):
+        """host.get selectors from `host_groups` and `hosts` options"""
+        params = {}
+        if self.groupids is not None:
+            params['groupids'] = self.groupids
+        if self.options.get('hosts'):
+            params['filter'] = {'host': self.options['hosts']}
+        return params
+
+    def item_params(self):
+        """item.get filters derived from config, so that API returns only items which can be exported
+
+           Non-numeric items are filtered out, with `explicit_metrics` only items
+           with keys matching some rule are requested (`*` becomes Zabbix search wildcard).
+           Filters only narrow the result, every item is still checked by exporter.
+        """
+        params = {'filter': {'value_type': EXPORTABLE_VALUE_TYPES}}
+        patterns = self.rules.search_patterns()
+        if self.options.get('explicit_metrics', False) and patterns:
+            params.update(search={'key_': patterns}, startSearch=True, searchByAny=True,
+                          searchWildcardsEnabled=True)
+        if self.groupids is not None:
+            params['groupids'] = self.groupids
+        return params
 
     def process_metric(self, item):
         if not self.is_exportable(item):
             logger.debug('Dropping unsupported metric %s', item['key_'])
+            self.dropped['unsupported'] += 1
             return
 
-        metric = item['key_']
-        metric_options = {}
-        labels_mapping = SortedDict()
-        for pattern, attrs in self.key_patterns.items():
-            match = re.match(pattern, item['key_'])
-            if match:
-                # process metric name
-                metric = attrs.get('name', metric)
-
-                def repl(m):
-                    asterisk_index = int(m.group(1))
-                    return match.group(asterisk_index)
-                metric = re.sub('\$(\d+)', repl, metric)
-
-                # ignore metrics with rejected placeholders
-                rejected_matches = [r for r in attrs.get('reject', []) if re.search(r, item['key_'])]
-                if rejected_matches:
-                    logger.debug('Rejecting metric %s (matched %s)', rejected_matches[0], metric)
-                    continue  # allow to process metric by another rule
-
-                # create labels
-                for label_name, match_group in attrs.get('labels', {}).items():
-                    if match_group[0] == '$':
-                        label_value = match.group(int(match_group[1]))
-                    else:
-                        label_value = match_group
-                    labels_mapping[label_name] = label_value
-                metric_options = attrs
-                break
+        instance = self.host_mapping[item['hostid']]  # automatic host -> instance labeling
+        rule, match = self.rules.match(item['key_'])
+        if rule is not None:
+            metric = rule.render_name(match)
+            labelnames = rule.labelnames
+            labelvalues = rule.render_labels(match, instance)
+            metric_type = rule.type
+            documentation = rule.documentation or item['name']
         else:
             if self.options.get('explicit_metrics', False):
                 logger.debug('Dropping implicit metric name %s', item['key_'])
+                self.dropped['implicit'] += 1
                 return
+            metric = item['key_']
+            labelnames = IMPLICIT_LABELNAMES
+            labelvalues = (instance,)
+            metric_type = 'untyped'  # untyped by default
+            documentation = item['name']
 
-        # automatic host -> instance labeling
-        labels_mapping['instance'] = self.host_mapping[item['hostid']]
-
-        logger.debug('Converted: %s -> %s [%s]', item['key_'], metric, labels_mapping)
+        logger.debug('Converted: %s -> %s %s=%s', item['key_'], metric, labelnames, labelvalues)
         return {
             'name': sanitize_key(metric),
-            'type': metric_options.get('type', 'untyped'),  # untyped by default
-            'documentation': metric_options.get('help', item['name']),
-            'labels_mapping': labels_mapping,
+            'type': metric_type,
+            'documentation': documentation,
+            'labelnames': labelnames,
+            'labelvalues': labelvalues,
         }
 
-    def collect(self):
+    def host_batches(self):
+        """Splits known hosts into batches of `host_batch_size`, or into one shard per API worker"""
+        hostids = sorted(self.host_mapping, key=int)
+        batch_size = self.options.get('host_batch_size') or int(math.ceil(len(hostids) / float(self.api_workers)))
+        batch_size = max(batch_size, 1)
+        return [hostids[offset:offset + batch_size] for offset in range(0, len(hostids), batch_size)]
+
+    def refresh_sharded_hosts(self):
+        """Reloads host mapping before full item fetch, when items are requested by batches of known hosts
+
+           Otherwise items of hosts added after startup are not requested until `host_refresh_interval` reloads hosts.
+        """
+        if self.options.get('host_refresh_interval') or not (self.options.get('host_batch_size') or
+                                                             self.api_workers > 1):
+            return
+        started = time.time()
+        self.host_mapping.refresh()
+        self.observe_stage('hosts', started)
+
+    def item_request(self, hostids=None, output=ITEM_OUTPUT, filtered=True):
+        """item.get parameters for one page of items"""
+        params = {'output': output, 'sortfield': 'key_'}
+        if filtered:
+            params.update(self.item_params())
+        if hostids is None and self.options.get('hosts'):
+            hostids = sorted(self.host_mapping, key=int)
+        if hostids is not None:
+            params['hostids'] = hostids
+        return params
+
+    def fetch_items(self, hostids=None, output=ITEM_OUTPUT, filtered=True):
+        params = self.item_request(hostids, output, filtered)
+        started = time.time()
+        items = self.zapi.item.get(**params)
+        self.observe_stage('api', started)
+        return items
+
+    def iter_item_pages(self, output=ITEM_OUTPUT, filtered=True):
+        """Yields lists of items, in pages of `host_batch_size` hosts if configured
+
+           Only one page of raw items is held in memory at a time,
+           families are assembled incrementally as pages arrive.
+           With `api_workers` pages are fetched in parallel, but still yielded in order,
+           at most `api_workers` pages are requested or waiting to be yielded at a time.
+           Without `filtered` all items are fetched, not only exportable ones.
+        """
+        if not self.options.get('host_batch_size') and self.pool is None:
+            yield self.fetch_items(output=output, filtered=filtered)
+            return
+
+        batches = self.host_batches()
+        if self.pool is None:
+            for hostids in batches:
+                yield self.fetch_items(hostids, output=output, filtered=filtered)
+        else:
+            fetch = partial(self.fetch_items, output=output, filtered=filtered)
+            pending = deque()
+            for hostids in batches:
+                pending.append(self.pool.apply_async(fetch, (hostids,)))
+                if len(pending) >= self.api_workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def item_cache_is_fresh(self):
+        refresh_interval = self.options.get('metadata_refresh_interval')
+        return bool(refresh_interval) and time.time() - self.item_cache_updated_at < refresh_interval
+
+    def iter_shards(self, output=ITEM_OUTPUT):
+        """Yields (hostids, items) for every shard, items are None if shard is not fetched before deadline
+
+           Shard still fetched for earlier scrape is not requested again, its result is awaited instead,
+           so that slow shards do not pile up in fetch pool.
+        """
+        deadline = time.time() + self.options['scrape_timeout']
+        if self.options.get('host_batch_size') or self.api_workers > 1:
+            batches = self.host_batches()
+        else:
+            batches = [None]
+        in_flight, self.in_flight = self.in_flight, {}
+        results = []
+        for hostids in batches:
+            key = tuple(hostids) if hostids is not None else None
+            shard_output, result = in_flight.get(key, (output, None))
+            if result is None or result.ready():  # result of earlier scrape is outdated when ready
+                shard_output, result = output, self.pool.apply_async(self.fetch_items, (hostids, output))
+            results.append((hostids, key, shard_output, result))
+        for hostids, key, shard_output, result in results:
+            try:
+                items = result.get(max(deadline - time.time(), 0))
+            except Exception as e:
+                if isinstance(e, multiprocessing.TimeoutError):
+                    self.in_flight[key] = (shard_output, result)
+                logger.warning('Items of %s hosts are not fetched in time: %r', len(hostids or self.host_mapping), e)
+                items = None
+            yield hostids, items if shard_output == output else None
+
+    def merge_shards(self, shards, values_only):
+        """Yields (metric, item) pairs of fetched shards, and last known ones for shards which are not fetched
+
+           Last known items older than `max_stale_age` seconds (10 minutes by default, 0 - no limit) are dropped.
+           Raises RuntimeError when nothing is fetched and there is nothing to fall back to.
+        """
+        shard_cache, self.shard_cache = self.shard_cache, {}
+        max_stale_age = self.options.get('max_stale_age', 600)
+        item_cache = {}
+        now = time.time()
+        oldest = now
+        stale = 0
+        for hostids, items in shards:
+            key = tuple(hostids) if hostids is not None else None
+            if items is None:
+                stale += 1
+                if key not in shard_cache:
+                    continue
+                if max_stale_age and now - shard_cache[key][1] > max_stale_age:
+                    logger.warning('Items of %s hosts are not fetched for %s seconds, dropping them',
+                                   len(hostids or self.host_mapping), max_stale_age)
+                    continue
+                values, fetched_at = self.shard_cache[key] = shard_cache[key]
+                oldest = min(oldest, fetched_at)
+                for metric, itemid, lastvalue, lastclock in values:
+                    item_cache[itemid] = metric
+                    yield metric, {'itemid': itemid, 'lastvalue': lastvalue, 'lastclock': lastclock}
+            else:
+                samples = self.page_samples(items, values_only, item_cache)
+                # only values are kept, not whole item.get rows
+                self.shard_cache[key] = ([(metric, item['itemid'], item['lastvalue'], item['lastclock'])
+                                          for metric, item in samples], now)
+                for sample in samples:
+                    yield sample
+        if stale and not self.shard_cache:
+            raise RuntimeError('No items are fetched before scrape deadline')
+        stale_shards.labels(self.name).set(stale)
+        staleness_seconds.labels(self.name).set(now - oldest)
+        if not values_only:
+            self.update_item_cache(item_cache)
+
+    def page_samples(self, items, values_only, item_cache):
+        if values_only:
+            return self.cached_samples(items)
+        started = time.time()
+        self.host_mapping.resolve(item['hostid'] for item in items)
+        self.observe_stage('hosts', started)
+        return self.process_items(items, item_cache)
+
+    def iter_samples(self):
+        """Yields (metric, item) pairs for every exported item
+
+           With `metadata_refresh_interval` processed metrics are cached by itemid,
+           and between metadata refreshes only values are fetched from API.
+           With `scrape_timeout` shards not fetched in time are served from earlier scrape.
+        """
+        values_only = self.item_cache_is_fresh()
+        if not values_only:
+            self.refresh_sharded_hosts()
+        if self.options.get('scrape_timeout'):
+            shards = self.iter_shards(output=VALUE_OUTPUT if values_only else ITEM_OUTPUT)
+            for sample in self.merge_shards(shards, values_only):
+                yield sample
+            return
+
+        if values_only:
+            for items in self.iter_item_pages(output=VALUE_OUTPUT):
+                for sample in self.cached_samples(items):
+                    yield sample
+            return
+
+        item_cache = {}
+        for items in self.iter_item_pages():
+            for sample in self.page_samples(items, False, item_cache):
+                yield sample
+        self.update_item_cache(item_cache)
+
+    def cached_samples(self, items):
+        """(metric, item) pairs for page of values-only items, with metrics from item cache"""
+        item_cache = self.item_cache
+        return [(item_cache[item['itemid']], item) for item in items if item['itemid'] in item_cache]
+
+    def process_items(self, items, item_cache):
+        """(metric, item) pairs for exported items of one page, processed metrics are put into item_cache
+
+           With `rule_processes` pages larger than `rule_chunk_size` items are processed by pool of processes.
+        """
+        started = time.time()
+        if self.rule_pool is not None and len(items) > self.rule_pool.chunk_size:
+            samples = self.rule_pool.process_items(self, items, item_cache)
+        else:
+            samples = []
+            for item in items:
+                metric = self.process_metric(item)
+                if metric:
+                    item_cache[item['itemid']] = metric
+                    samples.append((metric, item))
+        self.observe_stage('rules', started)
+        return samples
+
+    def update_item_cache(self, item_cache):
+        if self.options.get('metadata_refresh_interval'):
+            self.item_cache = item_cache
+            self.item_cache_updated_at = time.time()
+
+    def assemble(self, samples):
+        """Groups (metric, item) pairs into metric families"""
         series_count = 0
         enable_timestamps = self.options.get('enable_timestamps', False)
         # We need to iterate metrics twice, because zabbix metric names order
         # does not come in same order as prometheus metric names
         metric_families = OrderedDict()
-        items = self.zapi.item.get(output=['name', 'key_', 'hostid', 'lastvalue', 'lastclock', 'value_type'],
-                                   sortfield='key_')
-
-        for item in items:
-            metric = self.process_metric(item)
-            if not metric:
-                continue
-
+        for metric, item in samples:
             if metric['name'] not in metric_families:
                 family = MetricFamily(typ=metric['type'],
                                       name=metric['name'],
                                       documentation=metric['documentation'],
-                                      labels=metric['labels_mapping'].keys())
+                                      labels=metric['labelnames'])
                 metric_families[metric['name']] = family
             metric_families[metric['name']].add_metric(
-                metric['labels_mapping'].values(), float(item['lastvalue']),
+                metric['labelvalues'], float(item['lastvalue']),
                 int(item['lastclock']) if enable_timestamps else None)
             series_count += 1
 
-        for f in metric_families.values():
+        metrics_count_total.labels(self.name).set(len(metric_families))
+        series_count_total.labels(self.name).set(series_count)
+        return list(metric_families.values())
+
+    def collect(self):
+        started = time.time()
+        families = self.assemble(self.iter_samples())
+        self.observe_stage('collect', started)
+        for f in families:
             yield f
 
-        metrics_count_total.set(len(metric_families))
-        series_count_total.set(series_count)
+    def observe_stage(self, stage, started):
+        stage_seconds.labels(self.name, stage).observe(time.time() - started)
 
     def is_exportable(self, item):
-        return item['value_type'] in {'0', '3'}  # only numeric/float values
+        return item['value_type'] in EXPORTABLE_VALUE_TYPES  # only numeric/float values
+
+
+class MetricsCache(object):
+    """Pre-rendered metrics payload of target `name`, refreshed by background thread every `interval` seconds"""
+
+    def __init__(self, registry=REGISTRY, interval=60, name=''):
+        self.registry = registry
+        self.interval = interval
+        self.name = name
+        self.snapshot = (None, None)  # (payload, updated_at), replaced atomically
+        self.failed = False  # whether last refresh failed, payload is stale
+        self._compressed = (None, {})  # (payload, {encoding: compressed payload})
+        self.collection = SingleFlight()  # refresh on demand (profiling) shares refresh in progress
+        self.on_refresh = None  # called with (payload, updated_at) after every successful refresh
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def payload(self):
+        return self.snapshot[0]
+
+    def restore(self, snapshot):
+        """Serves payload saved in snapshot until first refresh"""
+        if snapshot is not None and snapshot.payload is not None:
+            self.snapshot = (snapshot.payload, snapshot.saved_at)
+            snapshot_age_seconds.labels(self.name).set_function(self.age)
+
+    def compressed_payload(self, encoding, level):
+        """Payload compressed once per refresh, not once per request"""
+        payload = self.payload
+        compressed = self._compressed
+        if compressed[0] is not payload:
+            compressed = self._compressed = (payload, {})
+        if encoding not in compressed[1]:
+            compressed[1][encoding] = compress(payload, encoding, level)
+        return compressed[1][encoding]
+
+    def age(self):
+        updated_at = self.snapshot[1]
+        if updated_at is None:
+            return float('nan')
+        return time.time() - updated_at
+
+    def refresh(self):
+        started = time.time()
+        try:
+            payload = self.collection.do(generate_latest, self.registry)
+        except Exception:
+            logger.exception('Background refresh failed')
+            refresh_failures_total.labels(self.name).inc()
+            self.failed = True
+            return False
+        updated_at = time.time()
+        self.snapshot = (payload, updated_at)
+        self.failed = False
+        refresh_seconds.labels(self.name).set(updated_at - started)
+        if self.on_refresh is not None:
+            self.on_refresh(payload, updated_at)
+        return True
+
+    def start(self):
+        snapshot_age_seconds.labels(self.name).set_function(self.age)
+        self._thread = threading.Thread(target=self._run, name='metrics-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            started = time.time()
+            self.refresh()
+            self._stopped.wait(max(self.interval - (time.time() - started), 0))
+
+
+class Target(object):
+    """Zabbix frontend exported by multi-target exporter
+
+       Every target has own collector, registry and poll schedule, so that slow
+       or failing frontend does not affect others. Collector is created on first use,
+       if Zabbix is not available it is created again on next scrape.
+       Polled targets restore state from `snapshot_path` and save it after every refresh,
+       snapshot is restored only if it is saved with same config `fingerprint`.
+    """
+
+    def __init__(self, name, collector_factory, poll_interval=0, snapshot_path=None, fingerprint=b''):
+        self.name = name
+        self.collector_factory = collector_factory
+        self.poll_interval = poll_interval
+        self.snapshot_path = snapshot_path if poll_interval else None
+        self.fingerprint = fingerprint
+        self.collector = None
+        self.registry = CollectorRegistry()
+        self.metrics_cache = None
+        self.snapshot = None  # restored into collector once it is created
+        if poll_interval:
+            self.metrics_cache = MetricsCache(self.registry, interval=poll_interval, name=name)
+            if self.snapshot_path:
+                self.snapshot = Snapshot.load(self.snapshot_path, fingerprint)
+                self.metrics_cache.restore(self.snapshot)
+        self.collection = SingleFlight()
+        self._lock = threading.Lock()
+        self._starting = None
+
+    def start(self):
+        """Logs in to Zabbix and starts polling, returns whether target is available"""
+        with self._lock:
+            if self.collector is None:
+                try:
+                    collector = self.collector_factory(snapshot=self.snapshot)
+                except Exception:
+                    logger.exception('Failed to connect to target %s', self.name)
+                    target_up.labels(self.name).set(0)
+                    return False
+                self.registry.register(collector)
+                self.registry.register(collector.rule_stats)
+                self.collector = collector
+                self.snapshot = None
+                if self.metrics_cache is not None:
+                    if self.snapshot_path:
+                        self.metrics_cache.on_refresh = partial(save_snapshot, self.snapshot_path, collector,
+                                                                fingerprint=self.fingerprint)
+                    self.metrics_cache.start()
+        return True
+
+    def start_in_background(self):
+        if self._starting is None or not self._starting.is_alive():
+            self._starting = threading.Thread(target=self.start, name='target-start')
+            self._starting.daemon = True
+            self._starting.start()
+
+    def payload(self):
+        """Rendered metrics of target, None if polled metrics are not collected yet
+
+           Payload restored from snapshot is served while collector connects to Zabbix in background.
+        """
+        cache = self.metrics_cache
+        if self.collector is None and cache is not None and cache.payload is not None:
+            self.start_in_background()
+            target_up.labels(self.name).set(0)
+            return cache.payload
+        if not self.start():
+            raise RuntimeError('Target %s is not available' % self.name)
+        if cache is not None:
+            target_up.labels(self.name).set(0 if cache.failed else 1)
+            return cache.payload
+        try:
+            payload = self.collection.do(generate_latest, self.registry)
+        except Exception:
+            target_up.labels(self.name).set(0)
+            raise
+        target_up.labels(self.name).set(1)
+        return payload
+
+    def stop(self):
+        if self.metrics_cache is not None:
+            self.metrics_cache.stop()
+        if self.collector is not None:
+            self.collector.close()
+
+
+class Startup(object):
+    """Initializes exporter in background thread, retrying every `retry_interval` seconds until it succeeds
+
+       Listener is bound before initialization starts, so /healthz is answered at once,
+       /ready and metrics endpoints - as soon as exporter is connected to Zabbix.
+    """
+
+    def __init__(self, setup, started_at=None, retry_interval=10):
+        self.setup = setup
+        self.started_at = started_at or time.time()
+        self.retry_interval = retry_interval
+        self.ready = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='startup')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.setup()
+            except Exception:
+                logger.exception('Exporter initialization failed, retrying in %s seconds', self.retry_interval)
+                self._stopped.wait(self.retry_interval)
+                continue
+            startup_seconds.set(time.time() - self.started_at)
+            self.ready.set()
+            return
 
 
 class MetricsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    timeout = 30  # drop clients stalled in the middle of request
+    idle_timeout = 5  # drop keep-alive connections not sending next request
+    worker_wait = 10  # seconds request waits for free worker before it is answered with 503
+    stream_buffer_size = 65536  # streamed response is buffered up to this size before headers are sent
+    has_worker = False
+
+    def handle_one_request(self):
+        """Waits for next request up to `idle_timeout`, handles it holding one of server workers
+
+           Idle keep-alive connections do not hold workers, so they can not starve scrapes and health checks.
+        """
+        if not wait_readable(self.rfile, self.connection, self.idle_timeout):
+            self.close_connection = True
+            return
+        self.connection.settimeout(self.timeout)
+        self.has_worker = acquire(self.server.workers, self.worker_wait)
+        try:
+            BaseHTTPRequestHandler.handle_one_request(self)
+        finally:
+            if self.has_worker:
+                self.server.workers.release()
+
     def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/')
+        if path == '/healthz':
+            return self.send_payload(200, b'OK\n', content_type='text/plain')
+        if not self.has_worker:
+            self.close_connection = True
+            return self.send_payload(503, b'Exporter is busy\n', content_type='text/plain')
+        ready = self.server.startup is None or self.server.startup.ready.is_set() or self.server.restored()
+        if path == '/ready':
+            return self.send_payload(200 if ready else 503, b'OK\n' if ready else b'Starting\n',
+                                     content_type='text/plain')
+        if not ready:
+            return self.send_payload(503, b'Exporter is starting\n', content_type='text/plain')
+        if self.server.profiling and path == '/debug/profile':
+            return self.send_profile()
+
+        cache = getattr(self.server, 'metrics_cache', None)
+        encoding = None
+        if self.server.compression_level:
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+        if self.server.targets:
+            if path == '/probe':
+                return self.send_target(parse_qs(url.query).get('target', [''])[0], encoding)
+            if path.startswith('/metrics/'):
+                return self.send_target(path[len('/metrics/'):], encoding)
+        if cache is None and self.server.stream and self.request_version != 'HTTP/1.0':
+            return self.stream_metrics(encoding)
+        started = time.time()
         try:
             scrapes_total.inc()
-            response = generate_latest(REGISTRY) + generate_latest(exporter_registry)
-            status = 200
+            if cache is None:
+                # concurrent scrapes share single in-flight collection
+                metrics = self.server.collection.do(collect, REGISTRY)
+                response = generate_latest(REGISTRY, metrics) + generate_latest(exporter_registry)
+                if encoding:
+                    response = compress(response, encoding, self.server.compression_level)
+                status = 200
+            elif cache.payload is None:
+                response = b'Metrics are not collected yet\n'
+                encoding = None
+                status = 503
+            elif encoding:
+                # concatenated gzip members (zstd frames) are decompressed as single stream
+                response = (cache.compressed_payload(encoding, self.server.compression_level) +
+                            compress(generate_latest(exporter_registry), encoding, self.server.compression_level))
+                status = 200
+            else:
+                response = cache.payload + generate_latest(exporter_registry)
+                status = 200
         except Exception:
             logger.exception('Fetch failed')
-            response = ''
+            response = b''
+            encoding = None
             status = 500
+        stage_seconds.labels(self.server.name, 'render').observe(time.time() - started)
+
+        started = time.time()
+        self.send_payload(status, response, encoding)
+        stage_seconds.labels(self.server.name, 'write').observe(time.time() - started)
+
+    def send_target(self, name, encoding=None):
+        """Metrics of single target, /probe?target=NAME or /metrics/NAME"""
+        target = self.server.targets.get(name)
+        if target is None:
+            return self.send_payload(404, b'Unknown target\n', content_type='text/plain')
+        started = time.time()
+        try:
+            scrapes_total.inc()
+            response = target.payload()
+            if response is None:
+                response = b'Metrics are not collected yet\n'
+                encoding = None
+                status = 503
+            else:
+                if encoding and target.metrics_cache is not None:
+                    response = target.metrics_cache.compressed_payload(encoding, self.server.compression_level)
+                elif encoding:
+                    response = compress(response, encoding, self.server.compression_level)
+                status = 200
+        except Exception:
+            logger.exception('Fetch from %s failed', name)
+            response = b''
+            encoding = None
+            status = 500
+        stage_seconds.labels(name, 'render').observe(time.time() - started)
+
+        started = time.time()
+        self.send_payload(status, response, encoding)
+        stage_seconds.labels(name, 'write').observe(time.time() - started)
+
+    def send_payload(self, status, response, encoding=None, content_type=CONTENT_TYPE_LATEST):
         self.send_response(status)
-        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(response)))
+        self.send_encoding_headers(encoding)
         self.end_headers()
         self.wfile.write(response)
 
+    def send_encoding_headers(self, encoding):
+        if self.server.compression_level:
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+
+    def stream_metrics(self, encoding=None):
+        """Writes metrics with chunked encoding as soon as each family is rendered
+
+           Metrics are collected first, sharing in-flight collection with concurrent scrapes,
+           only rendering is streamed. Headers are sent once `stream_buffer_size` bytes are rendered,
+           so errors while fetching from Zabbix API still result in clean 500 response.
+           Errors after that point abort the connection, leaving response truncated.
+        """
+        buffered = []
+        try:
+            scrapes_total.inc()
+            compressor = compressobj(encoding, self.server.compression_level) if encoding else None
+            metrics = self.server.collection.do(collect, REGISTRY)
+            chunks = chain(iter_latest(REGISTRY, metrics), iter_latest(exporter_registry))
+            size = 0
+            for chunk in chunks:
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= self.stream_buffer_size:
+                    break
+        except Exception:
+            logger.exception('Fetch failed')
+            return self.send_payload(500, b'')
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_encoding_headers(encoding)
+        self.end_headers()
+        try:
+            chunks = chain([b''.join(buffered)], chunks)
+            del buffered
+            for chunk in chunks:
+                self.write_chunk(compressor.compress(chunk) if compressor else chunk)
+            if compressor:
+                self.write_chunk(compressor.flush())
+        except Exception:
+            logger.exception('Fetch failed while streaming response')
+            self.close_connection = True
+            return
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_profile(self):
+        """Profiles next N collections, /debug/profile?scrapes=N&limit=50&filter=regex
+
+           Collections are shared with concurrent scrapes (refreshes of metrics cache with `--poll-interval`).
+           Stats are sorted by cumulative time, `filter` keeps only functions matching regex.
+        """
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            scrapes = int(query.get('scrapes', ['1'])[0])
+            limit = int(query.get('limit', ['50'])[0])
+        except ValueError:
+            return self.send_payload(400, b'scrapes and limit should be numbers\n', content_type='text/plain')
+
+        cache = self.server.metrics_cache
+        if cache is not None:
+            scrape = cache.refresh
+        else:
+            def scrape():
+                return generate_latest(REGISTRY, self.server.collection.do(collect, REGISTRY))
+        profiler = cProfile.Profile()
+        try:
+            for _ in range(max(min(scrapes, 100), 1)):
+                profiler.runcall(scrape)
+        except Exception:
+            logger.exception('Fetch failed')
+            return self.send_payload(500, b'')
+        output = codecs.getwriter('utf-8')(io.BytesIO())
+        restrictions = query.get('filter', []) + [limit]
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(*restrictions)
+        self.send_payload(200, output.getvalue(), content_type='text/plain; charset=utf-8')
+
+    def write_chunk(self, chunk):
+        if chunk:
+            self.wfile.write(('%x\r\n' % len(chunk)).encode('ascii') + chunk + b'\r\n')
+
     def log_message(self, format, *args):
         return
+
+
+class ExporterServer(ThreadingMixIn, HTTPServer):
+    """HTTP server with thread per connection
+
+       Up to `max_workers` requests are served at once, up to `max_connections`
+       (4 per worker by default) connections are kept open, further ones are answered with 503 at once.
+    """
+    daemon_threads = True
+    collector = None  # collector of single target exporter, closed with server
+    metrics_cache = None
+    targets = None  # name -> Target, served on /probe?target=NAME and /metrics/NAME
+    startup = None  # Startup, requests are answered with 503 until it is ready
+    name = ''  # target name of single target exporter, label of exporter own metrics
+    stream = False
+    compression_level = 0
+    profiling = False
+    busy_response = b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+    def __init__(self, server_address, handler_class, max_workers=16, max_connections=None):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.workers = threading.BoundedSemaphore(max_workers)
+        self.connections = threading.BoundedSemaphore(max_connections or max_workers * 4)
+        self.collection = SingleFlight()
+
+    def process_request(self, request, client_address):
+        if not self.connections.acquire(False):
+            # accept loop is never blocked: too many connections are rejected right away
+            self.reject(request)
+            return
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            self.connections.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.connections.release()
+
+    def reject(self, request):
+        try:
+            request.settimeout(1)
+            request.sendall(self.busy_response)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def restored(self):
+        """Whether metrics restored from snapshot can be served before exporter is connected to Zabbix"""
+        caches = [target.metrics_cache for target in self.targets.values()] if self.targets else [self.metrics_cache]
+        return any(cache is not None and cache.payload is not None for cache in caches)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        if self.startup is not None:
+            self.startup.stop()
+        if self.metrics_cache is not None:
+            self.metrics_cache.stop()
+        for target in (self.targets or {}).values():
+            target.stop()
+        if self.collector is not None:
+            self.collector.close()
@@ -0,0 +1,262 @@
+# coding: utf-8
+"""Items, hosts and latest values read straight from Zabbix database
+
+   For large installations frontend is the bottleneck: item.get with ``lastvalue``
+   looks up latest history of every item in PHP. ZabbixDatabase answers the few API calls
+   exporter makes (hostgroup.get, host.get, item.get) with batched SQL over pooled DB-API
+   connections and returns same rows as API, so that everything else in ZabbixCollector works as is.
+   Any DB-API 2.0 driver can be used: psycopg2, pymysql, MySQLdb, sqlite3.
+"""
+import importlib
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from operator import itemgetter
+
+from prometheus_client import Counter
+
+from .core import ZabbixCollector, exporter_registry
+
+logger = logging.getLogger(__name__)
+
+# value_type -> history table with values of this type
+HISTORY_TABLES = {
+    '0': 'history',  # numeric float
+    '1': 'history_str',
+    '2': 'history_log',
+    '3': 'history_uint',  # numeric unsigned
+    '4': 'history_text',
+}
+HOST_STATUSES = (0, 1)  # monitored, not monitored (templates are 3)
+HOST_FLAGS = (0, 4)  # plain and discovered hosts
+ITEM_FLAGS = (0, 4)  # plain and discovered items, not prototypes
+LIKE_ESCAPE = '!'
+ID_COLUMNS = ('itemid', 'value_type', 'hostid')
+
+db_queries_total = Counter('zabbix_exporter_db_queries_total', 'Queries to Zabbix database', registry=exporter_registry)
+db_seconds_total = Counter('zabbix_exporter_db_seconds_total', 'Seconds spent querying Zabbix database',
+                           registry=exporter_registry)
+
+
+class ConnectionPool(object):
+    """Up to `size` DB-API connections shared by threads, opened on demand"""
+
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.idle = []
+        self._available = threading.Semaphore(size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        self._available.acquire()
+        try:
+            with self._lock:
+                connection = self.idle.pop() if self.idle else None
+            if connection is None:
+                connection = self.connect()
+            try:
+                yield connection
+                connection.rollback()  # ends read transaction, connection does not stay idle in it
+            except Exception:
+                self.discard(connection)
+                raise
+            with self._lock:
+                self.idle.append(connection)
+        finally:
+            self._available.release()
+
+    def discard(self, connection):
+        """Closes connection which may be broken, new one is opened instead"""
+        try:
+            connection.close()
+        except Exception:
+            logger.debug('Failed to close database connection', exc_info=True)
+
+    def close(self):
+        with self._lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            self.discard(connection)
+
+
+class APIMethod(object):
+    """Stand-in for `zapi.<object>`, only `get` is supported"""
+
+    def __init__(self, get):
+        self.get = get
+
+
+class ZabbixDatabase(object):
+    """Answers hostgroup.get, host.get and item.get with rows read from Zabbix database
+
+       Only parameters exporter passes are supported. Latest value of item is its newest row
+       in history of last `history_period` seconds (all history if 0), looked up for every item
+       separately, so that (itemid, clock) index of history table serves it.
+       IN lists (and per-item lookups) are split into queries of `batch_size` ids.
+    """
+
+    def __init__(self, driver, connect=None, pool_size=4, history_period=86400, batch_size=1000):
+        self.module = importlib.import_module(driver)
+        self.pool = ConnectionPool(lambda: self.module.connect(**(connect or {})), pool_size)
+        self.history_period = history_period
+        self.batch_size = batch_size
+        self.hostgroup = APIMethod(self.get_hostgroups)
+        self.host = APIMethod(self.get_hosts)
+        self.item = APIMethod(self.get_items)
+
+    def placeholders(self, count):
+        marker = '?' if self.module.paramstyle == 'qmark' else '%s'
+        return ', '.join([marker] * count)
+
+    def query(self, sql, params=()):
+        started = time.time()
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+        db_queries_total.inc()
+        db_seconds_total.inc(time.time() - started)
+        return rows
+
+    def batches(self, ids):
+        """Splits ids into lists of `batch_size`, [None] if ids are not given"""
+        if ids is None:
+            return [None]
+        ids = [int(i) for i in ids]
+        return [ids[offset:offset + self.batch_size] for offset in range(0, len(ids), self.batch_size)]
+
+    def where_in(self, column, values, conditions, params):
+        if not values:
+            conditions.append('1 = 0')
+            return
+        conditions.append('%s IN (%s)' % (column, self.placeholders(len(values))))
+        params.extend(values)
+
+    def where_in_groups(self, column, groupids, conditions, params):
+        if not groupids:
+            conditions.append('1 = 0')
+            return
+        conditions.append('%s IN (SELECT hostid FROM hosts_groups WHERE groupid IN (%s))' % (
+            column, self.placeholders(len(groupids))))
+        params.extend(int(groupid) for groupid in groupids)
+
+    def get_hostgroups(self, output=None, filter=None):
+        conditions, params = ['1 = 1'], []
+        if filter and 'name' in filter:
+            self.where_in('name', filter['name'], conditions, params)
+        rows = self.query('SELECT groupid, name FROM hstgrp WHERE %s' % ' AND '.join(conditions), params)
+        return [{'groupid': str(groupid), 'name': name} for groupid, name in rows]
+
+    def get_hosts(self, output=None, hostids=None, groupids=None, filter=None):
+        result = []
+        for batch in self.batches(hostids):
+            conditions, params = [], []
+            self.where_in('status', HOST_STATUSES, conditions, params)
+            self.where_in('flags', HOST_FLAGS, conditions, params)
+            if batch is not None:
+                self.where_in('hostid', batch, conditions, params)
+            if groupids is not None:
+                self.where_in_groups('hostid', groupids, conditions, params)
+            if filter and 'host' in filter:
+                self.where_in('host', filter['host'], conditions, params)
+            rows = self.query('SELECT hostid, name FROM hosts WHERE %s' % ' AND '.join(conditions), params)
+            result.extend({'hostid': str(hostid), 'name': name} for hostid, name in rows)
+        return result
+
+    def get_items(self, output, hostids=None, groupids=None, filter=None, search=None, startSearch=False,
+                  searchByAny=False, searchWildcardsEnabled=False, sortfield=None):
+        """Items of hosts (not templates) with same fields as item.get `output`"""
+        columns = ['itemid', 'value_type'] + [column for column in ('hostid', 'name', 'key_')
+                                              if column in output or column == sortfield]
+        items = []
+        for batch in self.batches(hostids):
+            conditions, params = [], []
+            self.where_in('i.flags', ITEM_FLAGS, conditions, params)
+            self.where_in('h.status', HOST_STATUSES, conditions, params)
+            if batch is not None:
+                self.where_in('i.hostid', batch, conditions, params)
+            if groupids is not None:
+                self.where_in_groups('i.hostid', groupids, conditions, params)
+            if filter and 'value_type' in filter:
+                self.where_in('i.value_type', [int(value_type) for value_type in filter['value_type']],
+                              conditions, params)
+            if search and 'key_' in search:
+                patterns = [self.like_pattern(pattern, startSearch, searchWildcardsEnabled)
+                            for pattern in search['key_']]
+                joined = ' OR ' if searchByAny else ' AND '
+                conditions.append('(%s)' % joined.join(["i.key_ LIKE %s ESCAPE '%s'" % (
+                    self.placeholders(1), LIKE_ESCAPE)] * len(patterns)))
+                params.extend(patterns)
+            rows = self.query('SELECT %s FROM items i JOIN hosts h ON h.hostid = i.hostid WHERE %s' % (
+                ', '.join('i.' + column for column in columns), ' AND '.join(conditions)), params)
+            for row in rows:
+                item = dict(zip(columns, row))
+                for column in ID_COLUMNS:
+                    if column in item:
+                        item[column] = str(item[column])  # API returns ids as strings
+                items.append(item)
+
+        if 'lastvalue' in output or 'lastclock' in output:
+            self.add_last_values(items)
+        if sortfield:
+            items.sort(key=itemgetter(sortfield))
+        return [{field: item[field] for field in output} for item in items]
+
+    def like_pattern(self, pattern, start, wildcards):
+        for char in (LIKE_ESCAPE, '%', '_'):
+            pattern = pattern.replace(char, LIKE_ESCAPE + char)
+        if wildcards:
+            pattern = pattern.replace('*', '%')
+        return pattern + '%' if start else '%' + pattern + '%'
+
+    def add_last_values(self, items):
+        """Sets lastvalue and lastclock of items, '0' for items without recent history, like API does"""
+        by_type = defaultdict(list)
+        for item in items:
+            item['lastvalue'], item['lastclock'] = '0', '0'
+            if item['value_type'] in HISTORY_TABLES:
+                by_type[item['value_type']].append(item)
+        since = int(time.time()) - self.history_period if self.history_period else 0
+        for value_type, typed_items in by_type.items():
+            latest = self.last_values(HISTORY_TABLES[value_type], [item['itemid'] for item in typed_items], since)
+            for item in typed_items:
+                if item['itemid'] in latest:
+                    item['lastclock'], item['lastvalue'] = latest[item['itemid']]
+
+    def last_values(self, table, itemids, since):
+        """itemid -> (clock, value) of latest value in history `table`
+
+           Every item gets own ``ORDER BY clock DESC LIMIT 1`` lookup, joined with UNION ALL:
+           unlike MAX(clock) over IN list it reads one index entry per item, not whole period of history.
+        """
+        latest_row = ('SELECT * FROM (SELECT itemid, clock, value FROM %s WHERE itemid = %s AND clock > %d '
+                      'ORDER BY clock DESC, ns DESC LIMIT 1) l' % (table, self.placeholders(1), int(since)))
+        latest = {}
+        for batch in self.batches(itemids):
+            for itemid, clock, value in self.query(' UNION ALL '.join([latest_row] * len(batch)), batch):
+                latest[str(itemid)] = (str(clock), str(value))
+        return latest
+
+    def close(self):
+        self.pool.close()
+
+
+class DatabaseCollector(ZabbixCollector):
+    """Collector reading from Zabbix database given by `database` option instead of API
+
+       API arguments are accepted for compatibility with ZabbixCollector and ignored.
+    """
+
+    def __init__(self, base_url=None, login=None, password=None, verify_tls=True, timeout=None, snapshot=None,
+                 **options):
+        self.configure(options)
+        database = dict(options['database'])
+        database.setdefault('pool_size', self.api_workers + 1)  # fetch workers and host refresh thread
+        self.zapi = ZabbixDatabase(**database)
+        self.setup(snapshot)
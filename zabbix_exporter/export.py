@@ -0,0 +1,251 @@
+# coding: utf-8
+"""Latest item values from Zabbix real-time export files
+
+   Zabbix server 4.0+ with ``ExportDir`` set writes every history value as a line of NDJSON
+   into one file per history syncer, and renames the file to ``<name>.old`` when it grows
+   over ``ExportFileSize``. Instead of polling item.get for values exporter follows these files:
+   only appended bytes are read, in large blocks, and latest value of every exported item
+   is kept in memory. Item names, keys and hosts still come from item.get, which is called
+   only to refresh item metadata.
+"""
+import errno
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from prometheus_client import Counter
+
+from .core import ZabbixCollector, exporter_registry
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024  # bytes read from export file at once
+EXPORT_FILES = 'history-*.ndjson'  # rotated files end with .old and are not matched
+
+export_bytes_total = Counter('zabbix_exporter_export_bytes_total', 'Bytes read from Zabbix real-time export files',
+                             registry=exporter_registry)
+export_lines_total = Counter('zabbix_exporter_export_lines_total', 'Lines read from Zabbix real-time export files',
+                             registry=exporter_registry)
+export_errors_total = Counter('zabbix_exporter_export_errors_total',
+                              'Malformed lines in Zabbix real-time export files', registry=exporter_registry)
+
+
+class ExportFile(object):
+    """Lines appended to one export file, followed across rotations and truncations
+
+       File opened at exporter start is read from its end: values written before
+       are already known from item.get.
+    """
+
+    def __init__(self, path, from_end=False, read_size=READ_SIZE):
+        self.path = path
+        self.read_size = read_size
+        self.fd = None
+        self.inode = None
+        self.offset = 0
+        self.buffer = b''  # incomplete last line
+        self.partial = False  # whether data up to first newline is a tail of line written before start
+        self.open(from_end)
+
+    def open(self, from_end=False):
+        """Opens file at `path`, returns False if there is no such file"""
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        stat = os.fstat(fd)
+        self.fd, self.inode = fd, (stat.st_dev, stat.st_ino)
+        self.offset = 0
+        self.buffer = b''
+        self.partial = False
+        if from_end and stat.st_size:
+            os.lseek(fd, stat.st_size - 1, os.SEEK_SET)
+            self.partial = os.read(fd, 1) != b'\n'
+            self.offset = stat.st_size
+        return True
+
+    def close(self):
+        if self.buffer:
+            logger.warning('Incomplete line at the end of %s is dropped', self.path)
+        os.close(self.fd)
+        self.fd = None
+
+    def rotated(self):
+        """Whether file at `path` is renamed, replaced or truncated since it was opened"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_dev, stat.st_ino) != self.inode or stat.st_size < self.offset
+
+    def read_blocks(self):
+        """Yields lists of complete lines appended since last call"""
+        if self.fd is None and not self.open():
+            return
+        for lines in self.drain():
+            yield lines
+        if self.rotated():
+            for lines in self.drain():  # server may still write to renamed file before it reopens
+                yield lines
+            self.close()
+            if self.open():
+                for lines in self.drain():
+                    yield lines
+
+    def drain(self):
+        while True:
+            data = os.read(self.fd, self.read_size)
+            if not data:
+                return
+            self.offset += len(data)
+            export_bytes_total.inc(len(data))
+            if self.partial:
+                start = data.find(b'\n') + 1
+                if not start:
+                    continue
+                data = data[start:]
+                self.partial = False
+            if self.buffer:
+                data = self.buffer + data
+            end = data.rfind(b'\n') + 1
+            self.buffer = data[end:]
+            if end:
+                yield data[:end].splitlines()
+
+
+class ExportReader(object):
+    """Latest values of items from export files in `directory`, matching `pattern`
+
+       Values are kept only for items which are exported, see `retain`.
+       Files are read on `poll`, by background thread every `interval` seconds if started.
+    """
+
+    def __init__(self, directory, pattern=EXPORT_FILES, decoder=None, read_size=READ_SIZE):
+        self.pattern = os.path.join(directory, pattern)
+        self.decoder = decoder or json.loads
+        self.read_size = read_size
+        self.values = {}  # itemid -> ((clock, ns), value)
+        self.itemids = None  # values of other items are skipped, None - keep all
+        self.files = {}  # path -> ExportFile
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.discover(from_end=True)
+
+    def discover(self, from_end=False):
+        for path in sorted(glob.glob(self.pattern)):
+            if path not in self.files:
+                logger.debug('Following export file %s', path)
+                self.files[path] = ExportFile(path, from_end, self.read_size)
+
+    def poll(self):
+        """Reads everything appended to export files since last poll"""
+        with self._lock:
+            self.discover()
+            for path, export_file in list(self.files.items()):
+                for lines in export_file.read_blocks():
+                    self.update(lines)
+                if export_file.fd is None:
+                    del self.files[path]  # removed, new file with this name is read from start
+
+    def update(self, lines):
+        values, itemids, decode = self.values, self.itemids, self.decoder
+        count = 0
+        for line in lines:
+            if not line:
+                continue
+            count += 1
+            try:
+                row = decode(line)
+                itemid = str(row['itemid'])
+                stamp = (row['clock'], row.get('ns', 0))
+                value = row['value']
+            except (ValueError, KeyError, TypeError):
+                export_errors_total.inc()
+                continue
+            if itemids is not None and itemid not in itemids:
+                continue
+            known = values.get(itemid)
+            if known is None or stamp >= known[0]:
+                values[itemid] = (stamp, value)
+        export_lines_total.inc(count)
+
+    def seed(self, items):
+        """Takes last values of item.get result rows, unless export files have newer ones"""
+        with self._lock:
+            values = self.values
+            for item in items:
+                stamp = (int(item['lastclock']), 0)
+                known = values.get(item['itemid'])
+                if known is None or stamp > known[0]:
+                    values[item['itemid']] = (stamp, item['lastvalue'])
+
+    def retain(self, itemids):
+        """Keeps values only of `itemids` from now on"""
+        with self._lock:
+            self.itemids = set(itemids)
+            self.values = {itemid: value for itemid, value in self.values.items() if itemid in self.itemids}
+
+    def start(self, interval):
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='export-follow')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Reading export files failed')
+
+
+class ExportCollector(ZabbixCollector):
+    """Collector serving latest values from real-time export files of `export_dir`
+
+       Items are fetched from API every `metadata_refresh_interval` seconds (10 minutes by default)
+       to apply rules to new or changed items, their last values are used until export files
+       have newer ones. Files are read on every collection, and with `export_poll_interval`
+       also in background, so that collection reads only what is appended since.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ExportCollector, self).__init__(*args, **kwargs)
+        from .api import get_decoder
+        self.item_cache_updated_at = 0  # values of items restored from snapshot are unknown, fetch them
+        self.export = ExportReader(self.options['export_dir'], self.options.get('export_files', EXPORT_FILES),
+                                   decoder=get_decoder(self.options.get('json_decoder')))
+        if self.options.get('export_poll_interval'):
+            self.export.start(self.options['export_poll_interval'])
+
+    def item_cache_is_fresh(self):
+        return time.time() - self.item_cache_updated_at < self.options.get('metadata_refresh_interval', 600)
+
+    def refresh_items(self):
+        self.refresh_sharded_hosts()
+        item_cache = {}
+        for items in self.iter_item_pages():
+            self.export.seed(item for metric, item in self.page_samples(items, False, item_cache))
+        self.export.retain(item_cache)
+        self.item_cache = item_cache
+        self.item_cache_updated_at = time.time()
+
+    def iter_samples(self):
+        if not self.item_cache_is_fresh():
+            self.refresh_items()
+        self.export.poll()
+        values = self.export.values
+        for itemid, metric in self.item_cache.items():
+            latest = values.get(itemid)
+            if latest is not None:
+                (clock, ns), value = latest
+                yield metric, {'itemid': itemid, 'lastvalue': value, 'lastclock': clock}
@@ -0,0 +1,110 @@
+# coding: utf-8
+"""Metric rules applied to items by pool of worker processes
+
+   Every worker compiles rules from config once. Items are sent in chunks together
+   with names of their hosts, back travel only compact records: position of item in chunk,
+   index of metric family in chunk family table and label values. Chunks are merged in order,
+   so metric families come out exactly as if items were processed in exporter process.
+"""
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+_worker = None  # RuleWorker of current worker process
+
+
+def pool_context():
+    """Context starting workers from fork server, or spawning them where it is not available
+
+       Exporter process runs HTTP, fetch and refresh threads, forking it would copy
+       locks held by them into workers.
+    """
+    if not hasattr(multiprocessing, 'get_context'):  # python 2 only forks
+        return multiprocessing
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _init_worker(options):
+    global _worker
+    _worker = RuleWorker(options)
+
+
+def _process_chunk(chunk):
+    return _worker.process(*chunk)
+
+
+class RuleWorker(object):
+    """Applies rules to chunks of items inside worker process"""
+
+    def __init__(self, options):
+        from .core import HostCache, ZabbixCollector
+        self.collector = ZabbixCollector.__new__(ZabbixCollector)
+        self.collector.configure(options)
+        self.collector.host_mapping = HostCache(None)
+
+    def process(self, hosts, items):
+        """Returns (families, records, rule stats, dropped counters) for chunk of items"""
+        collector = self.collector
+        collector.host_mapping.mapping = hosts
+        families, family_index, records = [], {}, []
+        for position, item in enumerate(items):
+            metric = collector.process_metric(item)
+            if metric is None:
+                continue
+            family = (metric['name'], metric['type'], metric['documentation'], metric['labelnames'])
+            index = family_index.get(family)
+            if index is None:
+                index = family_index[family] = len(families)
+                families.append(family)
+            records.append((position, index, metric['labelvalues']))
+
+        stats = [(rule.matched, rule.rejected) for rule in collector.rules]
+        for rule in collector.rules:
+            rule.matched = rule.rejected = 0
+        dropped, collector.dropped = collector.dropped, dict.fromkeys(collector.dropped, 0)
+        return families, records, stats, dropped
+
+
+class RulePool(object):
+    """Pool of `processes` workers applying rules to chunks of `chunk_size` items, see `pool_context`"""
+
+    def __init__(self, options, processes, chunk_size=5000):
+        self.chunk_size = chunk_size
+        self.pool = pool_context().Pool(processes, initializer=_init_worker, initargs=(options,))
+
+    def chunks(self, items, host_mapping):
+        for offset in range(0, len(items), self.chunk_size):
+            chunk = items[offset:offset + self.chunk_size]
+            hostids = set(item['hostid'] for item in chunk)
+            yield {hostid: host_mapping[hostid] for hostid in hostids if hostid in host_mapping}, chunk
+
+    def process_items(self, collector, items, item_cache):
+        """Same (metric, item) pairs as `collector.process_items` would return"""
+        chunks = list(self.chunks(items, collector.host_mapping))
+        samples = []
+        for (hosts, chunk), (families, records, stats, dropped) in zip(
+                chunks, self.pool.imap(_process_chunk, chunks)):
+            for position, index, labelvalues in records:
+                name, typ, documentation, labelnames = families[index]
+                item = chunk[position]
+                metric = {
+                    'name': name,
+                    'type': typ,
+                    'documentation': documentation,
+                    'labelnames': labelnames,
+                    'labelvalues': labelvalues,
+                }
+                item_cache[item['itemid']] = metric
+                samples.append((metric, item))
+            for rule, (matched, rejected) in zip(collector.rules, stats):
+                rule.matched += matched
+                rule.rejected += rejected
+            for reason, count in dropped.items():
+                collector.dropped[reason] += count
+        return samples
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -3,11 +3,21 @@
    Code is vendored and forked to enable timestamps support in python client
    Copyright 2015 The Prometheus Authors
 """
-from .compat import StringIO
+from array import array
+from weakref import WeakKeyDictionary
+
+from .compat import StringIO, intern, zip
 from prometheus_client import core
 
 
 class MetricFamily(core.Metric):
+    """Metric family with compact samples storage
+
+       Label names tuple is shared by whole family, per-sample label values are
+       stored as tuples, values and timestamps - in parallel arrays of doubles.
+       Legacy `samples` list of (name, labels, value, timestamp) tuples
+       is only built when someone asks for it.
+    """
 
     def __init__(self, typ, name, documentation, value=None, labels=None):
         core.Metric.__init__(self, name, documentation, typ)
@@ -15,39 +25,156 @@ class MetricFamily(core.Metric):
             raise ValueError('Can only specify at most one of value and labels.')
         if labels is None:
             labels = []
-        self._labelnames = labels
+        self._labelnames = tuple(intern(str(label)) for label in labels)
         if value is not None:
             self.add_metric([], value)
 
     def add_metric(self, labels, value, timestamp=None):
-        self.samples.append((self.name, dict(zip(self._labelnames, labels)), value, timestamp))
-
-
-def generate_latest(registry=core.REGISTRY):
-    '''Returns the metrics from the registry in latest text format as a string.'''
-    output = []
-    for metric in registry.collect():
-        output.append('# HELP {0} {1}'.format(
-            metric.name, metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
-        output.append('\n# TYPE {0} {1}\n'.format(metric.name, metric.type))
-        for sample in metric.samples:
-            if len(sample) == 3:
-                name, labels, value = sample
-                timestamp = None
-            else:
-                name, labels, value, timestamp = sample
-            if labels:
-                labelstr = '{{{0}}}'.format(','.join(
-                    ['{0}="{1}"'.format(
-                     k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
-                     for k, v in sorted(labels.items())]))
-            else:
-                labelstr = ''
-            output.append('{0}{1} {2}{3}\n'.format(name, labelstr, core._floatToGoString(value),
-                                                   ' %s' % timestamp if timestamp else ''))
+        self._labelvalues.append(tuple(labels))
+        self._values.append(value)
+        self._timestamps.append(timestamp or 0)
+
+    def __len__(self):
+        return len(self._values)
+
+    def iter_series(self):
+        """Yields (label values, value, timestamp) for every sample"""
+        return zip(self._labelvalues, self._values, self._timestamps)
+
+    @property
+    def samples(self):
+        labelnames = self._labelnames
+        return [(self.name, dict(zip(labelnames, labelvalues)), value, int(timestamp) if timestamp else None)
+                for labelvalues, value, timestamp in self.iter_series()]
+
+    @samples.setter
+    def samples(self, samples):
+        self._labelvalues = []
+        self._values = array('d')
+        self._timestamps = array('d')
+        for sample in samples:
+            labels = sample[1]
+            self.add_metric([labels[label] for label in self._labelnames], sample[2],
+                            sample[3] if len(sample) > 3 else None)
+
+
+def collect(registry=core.REGISTRY):
+    '''Collects all metrics from the registry before any of them is rendered.'''
+    return list(registry.collect())
+
+
+def generate_latest(registry=core.REGISTRY, metrics=None):
+    '''Returns the metrics from the registry (or its already collected `metrics`) in latest text format.'''
+    return b''.join(iter_latest(registry, metrics))
+
+
+def iter_latest(registry=core.REGISTRY, metrics=None):
+    '''Yields the metrics from the registry (or its already collected `metrics`) in latest text format,
+       one encoded chunk per metric.'''
+    cache = _registry_caches.setdefault(registry, {})
+    for metric in registry.collect() if metrics is None else metrics:
+        yield render_metric(metric, cache)
+
+
+def render_metric(metric, cache=None):
+    '''Renders single metric with all its samples into bytes.
+
+       Label names order is computed once per metric (not once per sample),
+       label values are escaped only when they contain special characters,
+       rendered `name{labels}` prefixes are cached per series between scrapes.
+       `cache` keeps prefixes of every metric rendered last time, series which
+       are gone from the metric are dropped from it on next render.
+    '''
+    if cache is None:
+        cache = _series_cache
+    output = ['# HELP ', metric.name, ' ', _escape_help(metric.documentation),
+              '\n# TYPE ', metric.name, ' ', metric.type, '\n']
+    if isinstance(metric, MetricFamily):
+        _render_series(metric, output, cache)
+        return ''.join(output).encode('utf-8')
+
+    append = output.append
+    cached = cache.get(metric.name, _EMPTY)
+    rendered = {}
+    labelnames = ()
+    for sample in metric.samples:
+        name, labels, value = sample[0], sample[1], sample[2]
+        timestamp = sample[3] if len(sample) > 3 else None
+        if labels:
+            if len(labels) != len(labelnames):
+                labelnames = tuple(sorted(labels))
+            try:
+                key = (name, labelnames) + tuple([labels[k] for k in labelnames])
+            except KeyError:  # same number of labels, but different names
+                labelnames = tuple(sorted(labels))
+                key = (name, labelnames) + tuple([labels[k] for k in labelnames])
+            prefix = cached.get(key)
+            if prefix is None:
+                prefix = '%s{%s} ' % (name, ','.join([k + '="' + _escape_label_value(labels[k]) + '"'
+                                                      for k in labelnames]))
+            rendered[key] = prefix
+            append(prefix)
+        else:
+            append(name)
+            append(' ')
+        if value == value and value != _INF and value != _MINUS_INF:
+            append(repr(float(value)))
+        else:
+            append(core._floatToGoString(value))
+        if timestamp:
+            append(' %s' % timestamp)
+        append('\n')
+    cache[metric.name] = rendered
     return ''.join(output).encode('utf-8')
 
 
+def _render_series(family, output, cache):
+    '''Renders compact MetricFamily samples without materializing them'''
+    append = output.append
+    name = family.name
+    labelnames = family._labelnames
+    order = sorted(range(len(labelnames)), key=labelnames.__getitem__)
+    cache_key = (name, labelnames)
+    cached = cache.get(cache_key, _EMPTY)
+    rendered = {}
+    for labelvalues, value, timestamp in family.iter_series():
+        if labelnames:
+            prefix = cached.get(labelvalues)
+            if prefix is None:
+                prefix = '%s{%s} ' % (name, ','.join([labelnames[i] + '="' + _escape_label_value(labelvalues[i]) + '"'
+                                                      for i in order]))
+            rendered[labelvalues] = prefix
+            append(prefix)
+        else:
+            append(name)
+            append(' ')
+        if value == value and value != _INF and value != _MINUS_INF:
+            append(repr(value))
+        else:
+            append(core._floatToGoString(value))
+        if timestamp:
+            append(' %d' % timestamp)
+        append('\n')
+    cache[cache_key] = rendered
+
+
+_series_cache = {}  # metric -> {series: prefix}, for metrics rendered without registry
+_registry_caches = WeakKeyDictionary()  # registry -> its own cache, so that targets do not evict each other
+_EMPTY = {}
+_INF = float('inf')
+_MINUS_INF = float('-inf')
+
+
+def _escape_help(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _escape_label_value(value):
+    if '\\' in value or '\n' in value or '"' in value:
+        return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+    return value
+
+
 def text_string_to_metric_families(text):
     """Parse Prometheus text format from a string.
 
@@ -0,0 +1,138 @@
+# coding: utf-8
+"""Compiled metric rules from exporter config
+
+   Every rule from ``metrics`` section is compiled once on config load:
+   key pattern, rejects and name/labels templates become ready-to-call objects.
+   Rules are indexed by literal key prefix (everything before first ``*``),
+   so each item is tested only against rules which could possibly match it.
+"""
+import logging
+import re
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def sanitize_key(string):
+    return re.sub('[^a-zA-Z0-9:_]+', '_', string)
+
+
+def prepare_regex(key_pattern):
+    return re.escape(key_pattern).replace(r'\*', '([^,]*?)')
+
+
+def compile_template(template):
+    """Turns 'uwsgi_$1_$2' into callable, which renders it from regex match"""
+    parts = re.split(r'\$(\d+)', template)
+    if len(parts) == 1:
+        return lambda match: template
+    fmt = ''.join(
+        part.replace('{', '{{').replace('}', '}}') if i % 2 == 0 else '{%s}' % part
+        for i, part in enumerate(parts))
+
+    def render(match):
+        return fmt.format(match.group(0), *match.groups())
+    return render
+
+
+class Rule(object):
+    """Single compiled entry of ``metrics`` config section"""
+
+    def __init__(self, options):
+        self.options = options
+        self.key = options['key']
+        self.prefix = self.key.split('*', 1)[0]
+        self.regex = re.compile(prepare_regex(self.key))
+        self.rejects = [(r, re.compile(r)) for r in options.get('reject', [])]
+        self.type = options.get('type', 'untyped')  # untyped by default
+        self.documentation = options.get('help')
+        self.matched = 0  # statistics, exported by exporter
+        self.rejected = 0
+
+        if 'name' in options:
+            self.render_name = compile_template(options['name'])
+        else:
+            self.render_name = lambda match: match.string
+
+        # label schema: names order is fixed per rule, so samples carry plain value tuples
+        labels = dict(options.get('labels', {}))
+        labels.pop('instance', None)  # always set from host name
+        self.labelnames = tuple(sorted(list(labels) + ['instance']))
+        self.labels = []
+        for label_name in self.labelnames:
+            if label_name == 'instance':
+                self.labels.append((True, None, None))
+            elif labels[label_name][0] == '$':
+                self.labels.append((False, int(labels[label_name][1]), None))
+            else:
+                self.labels.append((False, None, labels[label_name]))
+
+    def match(self, key):
+        """Returns regex match for item key unless key is not matched or rejected"""
+        match = self.regex.match(key)
+        if match is None:
+            return None
+        for pattern, regex in self.rejects:
+            if regex.search(key):
+                logger.debug('Rejecting metric %s (matched %s)', pattern, key)
+                self.rejected += 1
+                return None
+        return match
+
+    def render_labels(self, match, instance):
+        """Label values in `labelnames` order"""
+        return tuple([instance if is_instance else match.group(group) if group is not None else literal
+                      for is_instance, group, literal in self.labels])
+
+
+class RuleSet(object):
+    """Ordered collection of rules with dispatch by literal key prefix
+
+       First matching (and not rejected) rule wins, in config order.
+    """
+
+    def __init__(self, metrics):
+        unique = OrderedDict()
+        for options in metrics:
+            unique[options['key']] = options
+        self.rules = [Rule(options) for options in unique.values()]
+
+        tables = {}
+        for index, rule in enumerate(self.rules):
+            tables.setdefault(len(rule.prefix), {}).setdefault(rule.prefix, []).append(index)
+        self._tables = sorted(tables.items())
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def search_patterns(self):
+        """Rule keys as Zabbix API key_ search patterns, None if some rule matches any key"""
+        if any(not rule.prefix for rule in self.rules):
+            return None
+        return [rule.key for rule in self.rules]
+
+    def candidates(self, key):
+        """Rules which literal prefix matches key, in config order"""
+        found = []
+        key_length = len(key)
+        for length, table in self._tables:
+            if length > key_length:
+                break
+            indexes = table.get(key[:length])
+            if indexes:
+                found.extend(indexes)
+        if len(found) > 1:
+            found.sort()
+        return [self.rules[index] for index in found]
+
+    def match(self, key):
+        """Returns (rule, regex match) pair for first matching rule or (None, None)"""
+        for rule in self.candidates(key):
+            match = rule.match(key)
+            if match is not None:
+                rule.matched += 1
+                return rule, match
+        return None, None
@@ -0,0 +1,130 @@
+# coding: utf-8
+"""On-disk snapshot of exporter state for warm restarts
+
+   Snapshot keeps host mapping, processed item metadata (itemid -> metric name/labels)
+   and last rendered payload, so that restarted exporter serves metrics right away
+   and fetches only values until metadata refresh.
+
+   File layout: header (magic, saved_at, config fingerprint, metadata length, payload length),
+   JSON metadata, raw payload. File is replaced atomically on save and mmap-ed on load.
+   Snapshot saved with different Zabbix URL or rules (see `config_fingerprint`) is not restored,
+   so that config changes apply right after restart.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ZBXSNAP2'
+HEADER = struct.Struct('<8sd20sII')  # magic, saved_at, config fingerprint, metadata length, payload length
+FINGERPRINT_OPTIONS = ('base_url', 'database', 'metrics', 'explicit_metrics', 'host_groups', 'hosts')
+
+
+def config_fingerprint(options):
+    """SHA-1 of collector options snapshot contents depend on: Zabbix it is read from, rules and host selection"""
+    config = {key: options.get(key) for key in FINGERPRINT_OPTIONS}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).digest()
+
+
+class Snapshot(object):
+    """Exporter state restorable into ZabbixCollector and MetricsCache"""
+
+    def __init__(self, hosts, items, payload=None, saved_at=None, items_updated_at=0, fingerprint=b''):
+        self.hosts = hosts  # hostid -> host name
+        self.items = items  # itemid -> processed metric, as in ZabbixCollector.item_cache
+        self.items_updated_at = items_updated_at
+        self.payload = payload
+        self.saved_at = saved_at or time.time()
+        self.fingerprint = fingerprint  # config_fingerprint of collector options
+
+    @classmethod
+    def from_collector(cls, collector, payload=None, saved_at=None, fingerprint=b''):
+        return cls(dict(collector.host_mapping.mapping), dict(collector.item_cache), payload, saved_at,
+                   collector.item_cache_updated_at, fingerprint)
+
+    def restore(self, collector):
+        """Puts hosts and item metadata into collector, item cache keeps its age"""
+        collector.host_mapping.mapping = dict(self.hosts)
+        collector.item_cache = dict(self.items)
+        collector.item_cache_updated_at = self.items_updated_at
+
+    def dumps(self):
+        # metrics of one family share name, type, help and label names, they are stored once
+        families, family_index, items = [], {}, {}
+        for itemid, metric in self.items.items():
+            family = (metric['name'], metric['type'], metric['documentation'], tuple(metric['labelnames']))
+            index = family_index.get(family)
+            if index is None:
+                index = family_index[family] = len(families)
+                families.append(family)
+            items[itemid] = [index, list(metric['labelvalues'])]
+        metadata = json.dumps({'hosts': self.hosts, 'families': families, 'items': items,
+                               'items_updated_at': self.items_updated_at},
+                              separators=(',', ':')).encode('utf-8')
+        payload = self.payload or b''
+        return (HEADER.pack(MAGIC, self.saved_at, self.fingerprint, len(metadata), len(payload)) +
+                metadata + payload)
+
+    @classmethod
+    def loads(cls, data):
+        magic, saved_at, fingerprint, metadata_length, payload_length = HEADER.unpack_from(data)
+        if magic != MAGIC or len(data) != HEADER.size + metadata_length + payload_length:
+            raise ValueError('Not an exporter snapshot')
+        offset = HEADER.size + metadata_length
+        metadata = json.loads(data[HEADER.size:offset].decode('utf-8'))
+        families = [(name, typ, documentation, tuple(labelnames))
+                    for name, typ, documentation, labelnames in metadata['families']]
+        items = {}
+        for itemid, (index, labelvalues) in metadata['items'].items():
+            name, typ, documentation, labelnames = families[index]
+            items[itemid] = {'name': name, 'type': typ, 'documentation': documentation,
+                             'labelnames': labelnames, 'labelvalues': tuple(labelvalues)}
+        payload = data[offset:offset + payload_length] or None
+        return cls(metadata['hosts'], items, payload, saved_at, metadata['items_updated_at'], fingerprint)
+
+    def save(self, path):
+        """Writes snapshot to temporary file and renames it over `path`"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.dumps())
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)  # atomic on POSIX
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, fingerprint=None):
+        """Reads snapshot from `path`, None if there is no valid snapshot saved with `fingerprint`"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    snapshot = cls.loads(data)
+                finally:
+                    data.close()
+        except (IOError, OSError, ValueError, KeyError, struct.error) as e:
+            logger.warning('Snapshot %s is not loaded: %s', path, e)
+            return None
+        if fingerprint is not None and snapshot.fingerprint != fingerprint:
+            logger.warning('Snapshot %s is saved with different config, not loaded', path)
+            return None
+        return snapshot
+
+
+def save_snapshot(path, collector, payload=None, saved_at=None, fingerprint=b''):
+    try:
+        Snapshot.from_collector(collector, payload, saved_at, fingerprint).save(path)
+    except Exception:
+        logger.exception('Failed to save snapshot %s', path)
@@ -1,4 +1,8 @@
 # coding: utf-8
+import threading
+import zlib
+
+from .compat import zstandard
 
 
 class SortedDict(dict):
@@ -8,3 +12,77 @@ class SortedDict(dict):
 
     def values(self):
         return [self[key] for key in self.keys()]
+
+
+class SingleFlight(object):
+    """Runs function once for all concurrent callers, sharing its result (or exception)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._call = None
+
+    def do(self, func, *args, **kwargs):
+        with self._lock:
+            call = self._call
+            leader = call is None
+            if leader:
+                call = self._call = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._call = None
+            call.done.set()
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def negotiate_encoding(accept_encoding):
+    """Picks response encoding (zstd or gzip) from Accept-Encoding header, None for identity"""
+    accepted = set()
+    for token in (accept_encoding or '').split(','):
+        parts = token.strip().split(';')
+        encoding = parts[0].strip().lower()
+        params = dict(p.strip().split('=', 1) for p in parts[1:] if '=' in p)
+        try:
+            if float(params.get('q', 1)) <= 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(encoding)
+    if zstandard is not None and 'zstd' in accepted:
+        return 'zstd'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compressobj(encoding, level):
+    """Streaming compressor with zlib-like compress()/flush() interface
+
+       Outputs of separate compressors can be concatenated:
+       both gzip members and zstd frames form valid multi-member streams.
+    """
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def compress(data, encoding, level):
+    compressor = compressobj(encoding, level)
+    return compressor.compress(data) + compressor.flush()